@@ -1,9 +1,16 @@
 # Imports-----------------------------------------------------------------------
 import sys
 import os
+import zlib
+import queue
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 import spicytwitch
 import spicybot_modules
+from spicybot_modules import outbound, storage, router
 
 # Global Variables--------------------------------------------------------------
 VERSION = "0.2.0"
@@ -23,97 +30,407 @@ upgrade_message = (
     ". Will return later.)"
 )
 
+# Async mode: number of threads module handlers are dispatched on, and how many
+# unprocessed lines a single channel may queue before the oldest are dropped.
+DEFAULT_WORKERS = 4
+MAX_CHANNEL_BACKLOG = 500
+
+# Set once the supervisor has told this process to stop, see run_supervisor().
+# supervisor_events is how a worker process reaches the supervisor, it's None
+# when the bot runs as a single process.
+stop_requested = threading.Event()
+supervisor_events = None
+
 logger = spicytwitch.log_tools.create_logger()
 
 # Other functions---------------------------------------------------------------
 def mass_notice(message:str):
     for channel in spicytwitch.irc.channels.keys():
-        spicytwitch.irc.chat(message, channel)
+        outbound.chat(message, channel, outbound.PRIORITY_ADMIN)
 
 
 def cleanup():
-    spicytwitch.irc.disconnect()
+    # Modules may queue messages as they shut down, so they go first
     spicytwitch.bot.run_cleanup()
+    if not outbound.flush():
+        logger.warning("Gave up on sending the remaining queued messages.")
+    logger.info("Outbound message stats: {}".format(outbound.get_stats()))
+    if not stop_requested.is_set():
+        # Otherwise it was already disconnected to stop the chat reader
+        spicytwitch.irc.disconnect()
+    # Modules close their own pools on shutdown, this catches any left open
+    storage.close_all()
 
 
-# The Bot-----------------------------------------------------------------------
-# NOTE: Make sure the config file has strict restrictions!
+def stop_everywhere(message: str) -> bool:
+    """Sends a notice to every channel and stops the bot.
 
+    Returns True if this process should stop now. A worker process instead
+    asks the supervisor to stop every worker, itself included.
+    """
+    if supervisor_events is not None:
+        supervisor_events.put(message)
+        return False
 
-# Loading config
-config_file = os.path.join(
-    os.path.expanduser('~'), '.spicyconfig'
-)
+    mass_notice(message)
+    return True
+
+
+def check_admin_command(user: spicytwitch.irc.User) -> bool:
+    """Handles the admin's shutdown and upgrade commands.
+
+    Returns True if the bot should stop running.
+    """
+    if user.name.lower() != admin:
+        return False
+
+    if user.command.lower() == shutdown:
+        logger.info("Received shutdown command from admin.")
+        return stop_everywhere(shutdown_message)
+    elif user.command.lower() == upgrade:
+        logger.info("Recieved upgrade command from admin.")
+        return stop_everywhere(upgrade_message)
 
-logger.info("Loading spicyconfig file.")
-with open(config_file, 'r') as config:
-    for index, line in enumerate(config.readlines()):
+    return False
+
+
+def dispatch(user: spicytwitch.irc.User):
+    """Passes a chat line to SpicyBot's own commands, then to the channel's
+    general commands, and to the bot manager if it was neither.
+    """
+    if router.route(user):
+        return
+    if spicybot_modules.general_command_manager.manage_general_commands(user):
+        return
+    spicytwitch.bot.manage_all_modules(user)
+
+
+# Run modes---------------------------------------------------------------------
+def run_sync():
+    """Reads and handles one chat line at a time."""
+    while not stop_requested.is_set():
+        try:
+            logger.debug("Requesting data from twitch")
+            if spicytwitch.irc.get_info():
+                logger.debug("Recieved data, checking if it is a chat line")
+                if spicytwitch.irc.user:
+                    logger.debug("Message was a chat line")
+                    user = spicytwitch.irc.user
+                    if check_admin_command(user):
+                        break
+                    else:
+                        logger.debug("Data will be passed to bot manager")
+                        dispatch(user)
+        except KeyboardInterrupt:
+            break
+        except OSError:
+            if stop_requested.is_set():
+                break
+            raise
+
+
+def read_chat(loop: asyncio.AbstractEventLoop, lines: asyncio.Queue):
+    """Reads chat lines off the socket and hands them to the event loop.
+
+    Runs on its own thread so that waiting on twitch never blocks the loop.
+    Once it stops it puts None on 'lines', or the error it stopped on if the
+    bot wasn't being stopped.
+    """
+    error = None
+    while not stop_requested.is_set():
         try:
-            CONFIG[line.split('=', 1)[0]] = line.split('=', 1)[1].strip()
-        except IndexError:
-            logger.warning("Failed to read configuration line #{}.".format(index))
+            if spicytwitch.irc.get_info() and spicytwitch.irc.user:
+                loop.call_soon_threadsafe(lines.put_nowait, spicytwitch.irc.user)
+        except OSError as exception:
+            # The socket is closed during cleanup, or to stop a worker
+            if not stop_requested.is_set():
+                error = exception
+            break
+
+    logger.debug("Chat reader stopped")
+    try:
+        loop.call_soon_threadsafe(lines.put_nowait, error)
+    except RuntimeError:
+        # The event loop has already finished, the bot is cleaning up
+        pass
 
 
-if "username" not in CONFIG or "oauth" not in CONFIG:
-    logger.warning("Username or oauth missing from config file.")
-    sys.exit(1)
+async def handle_channel(backlog: asyncio.Queue, executor: ThreadPoolExecutor):
+    """Dispatches a channel's lines, in the order they arrived.
 
-# Logging into twitch
-logger.info("Logging into twitch as '{}'.".format(CONFIG["username"]))
-if not spicytwitch.irc.connect(CONFIG["username"], CONFIG["oauth"], "tcp"):
-    logger.warning(
-        "Failed ot log into twitch. Please double check oauth or username"
+    Each channel has its own handler, so a slow command in one channel does not
+    hold up the others.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        user = await backlog.get()
+        try:
+            await loop.run_in_executor(executor, dispatch, user)
+        except Exception:
+            logger.exception(
+                "Module failed on line from channel '{}'".format(user.chatted_from)
+            )
+        finally:
+            backlog.task_done()
+
+
+async def run_async():
+    """Reads chat on a separate thread and dispatches lines concurrently.
+
+    The admin commands are checked as soon as a line arrives, before it is
+    queued behind any other channel's work.
+    """
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+    channel_backlogs = {}
+    channel_handlers = []
+    executor = ThreadPoolExecutor(
+        max_workers=int(CONFIG.get("workers", DEFAULT_WORKERS))
     )
-    sys.exit(1)
+
+    threading.Thread(target=read_chat, args=(loop, lines), daemon=True).start()
+
+    try:
+        while True:
+            user = await lines.get()
+            if isinstance(user, OSError):
+                logger.error("Lost the connection to twitch: {}".format(user))
+                raise user
+            if user is None or check_admin_command(user):
+                break
+
+            if user.chatted_from not in channel_backlogs:
+                channel_backlogs[user.chatted_from] = asyncio.Queue()
+                channel_handlers.append(loop.create_task(handle_channel(
+                    channel_backlogs[user.chatted_from], executor
+                )))
+
+            backlog = channel_backlogs[user.chatted_from]
+            if backlog.qsize() >= MAX_CHANNEL_BACKLOG:
+                logger.warning(
+                    "Channel '{}' is falling behind, dropping oldest line".format(
+                        user.chatted_from
+                    )
+                )
+                backlog.get_nowait()
+                backlog.task_done()
+            backlog.put_nowait(user)
+    finally:
+        for handler in channel_handlers:
+            handler.cancel()
+        executor.shutdown(wait=True)
+
+
+# Worker processes--------------------------------------------------------------
+def partition_channels(channels: list, processes: int) -> list:
+    """Splits channels between processes, leaving out empty partitions.
+
+    A channel always lands in the same partition for the same number of
+    processes, so its data is only ever used by one process at a time.
+    """
+    partitions = [[] for index in range(processes)]
+    for channel in channels:
+        index = zlib.crc32(channel.lower().encode('utf-8')) % processes
+        partitions[index].append(channel)
+    return [partition for partition in partitions if partition]
+
+
+def listen_to_supervisor(commands: multiprocessing.Queue):
+    """Waits for the supervisor to send the notice this worker stops with."""
+    message = commands.get()
+    mass_notice(message)
+    if not outbound.flush():
+        logger.warning("Gave up on sending the remaining queued messages.")
+    stop_requested.set()
+    # Wakes up the chat reader, which is waiting on the socket
+    spicytwitch.irc.disconnect()
+
+
+def run_worker(config: dict, channels: list, processes: int,
+               commands: multiprocessing.Queue, events: multiprocessing.Queue):
+    """Runs the bot for a share of the channels, see run_supervisor()."""
+    global supervisor_events
+
+    CONFIG.update(config)
+    supervisor_events = events
+    threading.Thread(
+        target=listen_to_supervisor, args=(commands,), daemon=True
+    ).start()
+    run_bot(channels, processes)
 
 
-if len(sys.argv) > 1:
-    join_these = sys.argv[1:]
-else:
-    join_these = CONFIG["channels"].split(',')
+def run_supervisor(channels: list, processes: int):
+    """Splits the channels between worker processes, each with its own
+    connection to twitch and its own modules, and stops them all together.
 
-if not join_these:
-    logger.info("Not given any channels to join, aborting")
-    sys.exit()
+    A worker passes the admin's shutdown and upgrade commands on through the
+    'events' queue, and the supervisor sends every worker the notice to stop
+    with through its own 'commands' queue. Only the workers load the command
+    modules, each bringing the shared database files up to date under a file
+    lock, so the supervisor holds none of their data or timers.
+    """
+    # Workers start from a fresh interpreter rather than a copy of this one,
+    # so they don't inherit its database connections and timers.
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
 
-# Joining channels
-for channel in join_these:
-    if channel:
-        channel = channel.strip()
+    partitions = partition_channels(channels, processes)
+    workers = []
+    for index, partition in enumerate(partitions):
+        commands = context.Queue()
+        worker = context.Process(
+            target=run_worker, name="spicybot-worker-{}".format(index),
+            args=(CONFIG, partition, len(partitions), commands, events)
+        )
+        worker.start()
+        logger.info("Started worker {} for {} channels.".format(
+            index, len(partition)
+        ))
+        workers.append((worker, commands))
+
+    try:
+        while any(worker.is_alive() for worker, commands in workers):
+            try:
+                message = events.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            logger.info("Stopping every worker.")
+            for worker, commands in workers:
+                commands.put(message)
+            break
+    except KeyboardInterrupt:
+        # The workers get the interrupt as well, and stop on their own
+        pass
+
+    for index, (worker, commands) in enumerate(workers):
+        worker.join()
+        if worker.exitcode:
+            logger.warning("Worker {} exited with code {}.".format(
+                index, worker.exitcode
+            ))
+
+
+# The Bot-----------------------------------------------------------------------
+# NOTE: Make sure the config file has strict restrictions!
+def load_config():
+    config_file = os.path.join(
+        os.path.expanduser('~'), '.spicyconfig'
+    )
+
+    logger.info("Loading spicyconfig file.")
+    with open(config_file, 'r') as config:
+        for index, line in enumerate(config.readlines()):
+            try:
+                CONFIG[line.split('=', 1)[0]] = line.split('=', 1)[1].strip()
+            except IndexError:
+                logger.warning("Failed to read configuration line #{}.".format(index))
+
+    if "username" not in CONFIG or "oauth" not in CONFIG:
+        logger.warning("Username or oauth missing from config file.")
+        sys.exit(1)
+
+
+def run_bot(channels: list, processes: int=1):
+    """Joins the channels and handles their chat until the bot is stopped.
+
+    'processes' is the number of bots sharing the account's message limit.
+    """
+    global admin
+
+    spicybot_modules.load_command_modules()
+
+    # Logging into twitch
+    logger.info("Logging into twitch as '{}'.".format(CONFIG["username"]))
+    if not spicytwitch.irc.connect(CONFIG["username"], CONFIG["oauth"], "tcp"):
+        logger.warning(
+            "Failed ot log into twitch. Please double check oauth or username"
+        )
+        sys.exit(1)
+
+    # Twitch allows moderators and verified bots to send messages faster
+    if "message_limit" in CONFIG or processes > 1:
+        message_limit = int(
+            CONFIG.get("message_limit", outbound.GLOBAL_MESSAGES)
+        )
+        outbound.set_limits(global_messages=max(message_limit // processes, 1))
+
+    # Memory used for quotes, counted in quotes as their size varies little
+    if "max_loaded_quotes" in CONFIG:
+        spicybot_modules.quotes.set_cache_limits(
+            int(CONFIG["max_loaded_quotes"])
+        )
+
+    # How often death counts are written, and how safely
+    write_policy = {}
+    if "deathcount_write_behind" in CONFIG:
+        write_policy["write_behind"] = (
+            CONFIG["deathcount_write_behind"].lower() in ("on", "true", "yes")
+        )
+    if "deathcount_flush_interval" in CONFIG:
+        write_policy["flush_interval"] = float(
+            CONFIG["deathcount_flush_interval"]
+        )
+    if "deathcount_flush_threshold" in CONFIG:
+        write_policy["flush_threshold"] = int(
+            CONFIG["deathcount_flush_threshold"]
+        )
+    if "deathcount_journal_mode" in CONFIG:
+        write_policy["journal_mode"] = CONFIG["deathcount_journal_mode"]
+    if "deathcount_synchronous" in CONFIG:
+        write_policy["synchronous"] = CONFIG["deathcount_synchronous"]
+    if write_policy:
+        spicybot_modules.deathcount.set_write_policy(**write_policy)
+
+    # Joining channels
+    for channel in channels:
         logger.info("{} is now entering the channel '{}'".format(
                 CONFIG["username"], channel
             )
         )
         spicytwitch.irc.join_channel(channel)
-        spicytwitch.irc.chat(entrance_message, channel)
-    
-# Listning to chat
-logger.info("{} will now begin monitoring chat.".format(CONFIG["username"]))   
-admin = CONFIG["admin"]
-while True:
-    try:
-        logger.debug("Requesting data from twitch")
-        if spicytwitch.irc.get_info():
-            logger.debug("Recieved data, checking if it is a chat line")
-            if spicytwitch.irc.user:
-                logger.debug("Message was a chat line")
-                user = spicytwitch.irc.user
-                if user.command.lower() == shutdown and user.name.lower() == admin:
-                    logger.info("Received shutdown command from admin.")
-                    mass_notice(shutdown_message)
-                    break
-                elif user.command.lower() == upgrade and user.name.lower() == admin:
-                    logger.info("Recieved upgrade command from admin.")
-                    mass_notice(upgrade_message)
-                    break
-                else:
-                    logger.debug("Data will be passed to bot manager")
-                    spicytwitch.bot.manage_all_modules(user)
-    except KeyboardInterrupt:
-        break
+        outbound.chat(entrance_message, channel)
+
+    # Listning to chat
+    logger.info("{} will now begin monitoring chat.".format(CONFIG["username"]))
+    admin = CONFIG["admin"]
+    if CONFIG.get("mode", "sync").lower() == "async":
+        logger.info("Running in async mode.")
+        try:
+            asyncio.run(run_async())
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_sync()
+
+    logger.info("Running cleanup")
+    cleanup()
+
+
+def main():
+    load_config()
+
+    if len(sys.argv) > 1:
+        join_these = sys.argv[1:]
+    else:
+        join_these = CONFIG["channels"].split(',')
+    join_these = [channel.strip() for channel in join_these if channel.strip()]
+
+    if not join_these:
+        logger.info("Not given any channels to join, aborting")
+        sys.exit()
+
+    processes = min(int(CONFIG.get("processes", 1)), len(join_these))
+    if processes > 1:
+        logger.info("Splitting {} channels between {} processes.".format(
+            len(join_these), processes
+        ))
+        run_supervisor(join_these, processes)
+    else:
+        run_bot(join_these)
 
+    logger.info("Goodbye! Have a nice day :)")
 
-logger.info("Running cleanup")
-cleanup()
-logger.info("Goodbye! Have a nice day :)")
 
+if __name__ == "__main__":
+    main()
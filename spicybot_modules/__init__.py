@@ -1 +1,7 @@
-from . import deathcount, quotes, sacrifice
+from . import storage, cooldowns, outbound, router
+
+
+# Importing a command module registers its commands, loads its data and starts
+# its timers, so they're only loaded in the process that runs the bot.
+def load_command_modules():
+    from . import deathcount, quotes, sacrifice, general_command_manager
@@ -0,0 +1,149 @@
+"""
+Description:
+User levels and command cooldowns, shared by every module.
+
+A user's level is worked out from the badge flags twitch already sent with
+their message, and compared as a number against the level a command needs,
+which is looked up once when the command is registered.
+
+Cooldowns are kept per channel. Each channel has a flat array of the times its
+commands were last used, one entry per command and cooldown group, so checking
+and starting a cooldown is two dict lookups and an array index. Channels whose
+cooldowns have all run out are dropped every so often, rather than tracking
+each entry's expiry.
+"""
+
+# Imports-----------------------------------------------------------------------
+import time
+import threading
+from array import array
+
+# Global Variables--------------------------------------------------------------
+LEVELS = ("everyone", "subscriber", "moderator", "broadcaster")
+EVERYONE, SUBSCRIBER, MODERATOR, BROADCASTER = range(len(LEVELS))
+LEVEL_RANKS = {name: rank for rank, name in enumerate(LEVELS)}
+
+# Moderators and the broadcaster share one cooldown, everyone else another.
+GROUP_EVERYONE = 0
+GROUP_MODERATOR = 1
+GROUPS = 2
+
+# Last use of a command that hasn't been used yet
+NEVER = float('-inf')
+
+# Seconds between sweeps for channels with no cooldowns left running.
+SWEEP_INTERVAL = 300.0
+
+
+# User levels-------------------------------------------------------------------
+def level_rank(level: str) -> int:
+    """Returns the rank of a user level's name. Unknown levels are treated as
+    broadcaster only, so a typo never opens a command up to everyone.
+    """
+    return LEVEL_RANKS.get(level.lower(), BROADCASTER)
+
+
+def user_rank(user) -> int:
+    """Returns the rank of the user who sent a message."""
+    name = user.name
+    channel = user.chatted_from
+    # Only lowercase the name when it could be the channel's
+    if len(name) == len(channel) and (
+            name == channel or name.lower() == channel.lower()):
+        return BROADCASTER
+    if user.is_mod:
+        return MODERATOR
+    if user.is_sub:
+        return SUBSCRIBER
+    return EVERYONE
+
+
+def cooldown_group(rank: int) -> int:
+    return GROUP_MODERATOR if rank >= MODERATOR else GROUP_EVERYONE
+
+
+# Cooldowns---------------------------------------------------------------------
+class ChannelCooldowns:
+    """The last use of each of a channel's commands, per cooldown group."""
+    __slots__ = ("slots", "times", "expires")
+
+    def __init__(self):
+        # Command key -> index of its first entry in 'times'
+        self.slots = {}
+        self.times = array('d')
+        # Once past this time, every cooldown in the channel has run out
+        self.expires = 0.0
+
+    def slot(self, key) -> int:
+        try:
+            return self.slots[key]
+        except KeyError:
+            slot = len(self.times)
+            self.slots[key] = slot
+            self.times.extend([NEVER] * GROUPS)
+            return slot
+
+
+class Cooldowns:
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+    def check(self, channel: str, key, group: int, cooldown: float) -> bool:
+        """Returns True, and starts the cooldown, if the command identified by
+        'key' may be used in a channel by the given cooldown group.
+        """
+        if not cooldown:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+
+            try:
+                cooldowns = self.channels[channel]
+            except KeyError:
+                cooldowns = ChannelCooldowns()
+                self.channels[channel] = cooldowns
+
+            index = cooldowns.slot(key) + group
+            if now - cooldowns.times[index] < cooldown:
+                return False
+
+            cooldowns.times[index] = now
+            if now + cooldown > cooldowns.expires:
+                cooldowns.expires = now + cooldown
+            return True
+
+    def forget(self, channel: str, key):
+        """Clears a command's cooldowns in a channel, e.g. once it's deleted."""
+        with self.lock:
+            cooldowns = self.channels.get(channel)
+            if cooldowns is None or key not in cooldowns.slots:
+                return
+            index = cooldowns.slots[key]
+            for group in range(GROUPS):
+                cooldowns.times[index + group] = NEVER
+
+    def _sweep(self, now: float):
+        expired = [
+            channel for channel, cooldowns in self.channels.items()
+            if cooldowns.expires <= now
+        ]
+        for channel in expired:
+            del self.channels[channel]
+        self.next_sweep = now + SWEEP_INTERVAL
+
+
+engine = Cooldowns()
+
+
+# Outer interface---------------------------------------------------------------
+def check(channel: str, key, group: int, cooldown: float) -> bool:
+    return engine.check(channel, key, group, cooldown)
+
+
+def forget(channel: str, key):
+    engine.forget(channel, key)
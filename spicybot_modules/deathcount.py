@@ -8,11 +8,13 @@ managing of deaths during livestreams.
 """
 
 # Imported Modules--------------------------------------------------------------
-import re
-import sqlite3
-import warnings
 import os
+import time
+import inspect
+import functools
+import threading
 import spicytwitch
+from . import outbound, storage, router
 
 # Global Variables--------------------------------------------------------------
 IRC = spicytwitch.irc
@@ -25,6 +27,27 @@ RESERVED_COMMAND_NAMES = [
     "deathcount"
 ]
 
+# Write-behind: changes to death counts are kept in memory and written in a
+# single transaction once FLUSH_THRESHOLD counts have changed, or FLUSH_INTERVAL
+# seconds after the first change, whichever comes first. Set WRITE_BEHIND to
+# False to write every change as it happens.
+WRITE_BEHIND = True
+FLUSH_INTERVAL = 5.0
+FLUSH_THRESHOLD = 50
+
+# SQLite durability, see storage.DEFAULT_PRAGMAS. These and the flush settings
+# can be changed with set_write_policy(), see "deathcount_*" in main.py.
+JOURNAL_MODE = "WAL"
+SYNCHRONOUS = "NORMAL"
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# Death events more than this many seconds apart are counted as being from
+# different streams. Rates are never worked out over less than
+# MIN_STATS_DURATION seconds, so one early death isn't reported as 60 an hour.
+STREAM_GAP = 6 * 60 * 60
+MIN_STATS_DURATION = 10 * 60
+
 
 # Regex-------------------------------------------------------------------------
 deathcount_regex = r"dc( [\w\W ]+)?"
@@ -34,6 +57,7 @@ add_game_regex = r"deathcount add game ([\w\W A-Z]+)"
 remove_game_regex = r"deathcount remove game ([\w\W A-Z]+)"
 set_game_regex = r"deathcount set game ([\w\W A-Z]+)"
 set_nickname_regex = r"deathcount set nickname (\w+)"
+stats_regex = r"deathcount stats( [\w\W ]+)?"
 
 
 # Module Registration-----------------------------------------------------------
@@ -43,84 +67,363 @@ storage_directory = module_tools.get_storage_directory()
 
 
 # Database----------------------------------------------------------------------
-connection = sqlite3.connect(os.path.join(storage_directory, __name__))
-cursor = connection.cursor()
-
-# Setup database on startup
-# Setting up nickname table
-# NOTE: This is not affected by channels as it is capitalized
-cursor.execute(
-    "CREATE TABLE IF NOT EXISTS nicknames "
-    "(nickname TEXT, channel TEXT)"
+pool = storage.open_pool(
+    os.path.join(storage_directory, __name__),
+    pragmas=(("journal_mode", JOURNAL_MODE), ("synchronous", SYNCHRONOUS))
 )
 
-cursor.execute(
-    "CREATE TABLE IF NOT EXISTS deathcount "
-    "(game TEXT, count INT, isdefault TEXT, channel TEXT)"
-)
+# Commands may be handled on worker threads (see the async mode in main.py).
+# Each thread gets its own connection from the pool, but a channel's cached data
+# may only be used by one thread at a time, so every function that takes a
+# channel holds that channel's lock. Commands in different channels still run
+# at the same time.
+channel_locks = {}
+
+
+def _channel_lock(channel: str) -> threading.RLock:
+    channel = channel.lower()
+    try:
+        return channel_locks[channel]
+    except KeyError:
+        return channel_locks.setdefault(channel, threading.RLock())
+
+
+def _locked(function):
+    position = list(inspect.signature(function).parameters).index("channel")
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if "channel" in kwargs:
+            channel = kwargs["channel"]
+        else:
+            channel = args[position]
+        with _channel_lock(channel):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# Schema------------------------------------------------------------------------
+# Each migration brings the database from the version before it to its own
+# version (its position in the list plus one). The version the database is at
+# is kept in SQLite's user_version, and every migration that hasn't been applied
+# yet is run in its own transaction on startup. Never edit a migration once it
+# has been released, add a new one instead.
+MIGRATIONS = [
+    # 1: The original tables, without keys or indexes.
+    """
+    CREATE TABLE IF NOT EXISTS nicknames
+        (nickname TEXT, channel TEXT);
+    CREATE TABLE IF NOT EXISTS deathcount
+        (game TEXT, count INT, isdefault TEXT, channel TEXT);
+    """,
+
+    # 2: Key death counts and nicknames by channel, and move each channel's
+    # default game out of the 'isdefault' column into its own table.
+    """
+    CREATE TABLE deathcount_v2 (
+        channel TEXT NOT NULL,
+        game TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (channel, game)
+    ) WITHOUT ROWID;
+    INSERT INTO deathcount_v2 (channel, game, count)
+        SELECT lower(channel), lower(game), COALESCE(MAX(count), 0)
+        FROM deathcount
+        WHERE channel IS NOT NULL AND game IS NOT NULL
+        GROUP BY lower(channel), lower(game);
+
+    CREATE TABLE default_games (
+        channel TEXT PRIMARY KEY,
+        game TEXT NOT NULL
+    ) WITHOUT ROWID;
+    INSERT INTO default_games (channel, game)
+        SELECT lower(channel), lower(game)
+        FROM deathcount
+        WHERE isdefault='YES' AND channel IS NOT NULL AND game IS NOT NULL
+        ORDER BY rowid
+        ON CONFLICT (channel) DO NOTHING;
+
+    CREATE TABLE nicknames_v2 (
+        channel TEXT PRIMARY KEY,
+        nickname TEXT NOT NULL
+    ) WITHOUT ROWID;
+    INSERT INTO nicknames_v2 (channel, nickname)
+        SELECT lower(channel), nickname
+        FROM nicknames
+        WHERE channel IS NOT NULL AND nickname IS NOT NULL
+        ORDER BY rowid
+        ON CONFLICT (channel) DO UPDATE SET nickname=excluded.nickname;
+
+    DROP TABLE deathcount;
+    DROP TABLE nicknames;
+    ALTER TABLE deathcount_v2 RENAME TO deathcount;
+    ALTER TABLE nicknames_v2 RENAME TO nicknames;
+    """,
+
+    # 3: A log of every death, rows are only ever appended.
+    """
+    CREATE TABLE death_events (
+        ts REAL NOT NULL,
+        channel TEXT NOT NULL,
+        game TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        moderator TEXT
+    );
+    CREATE INDEX death_events_by_game ON death_events (channel, game, ts);
+    """,
+
+    # 4: Resets are logged as events too, taking the count back to zero.
+    """
+    ALTER TABLE death_events ADD COLUMN is_reset INTEGER NOT NULL DEFAULT 0;
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate():
+    """Brings the database up to SCHEMA_VERSION."""
+    # Other bot processes may be starting up at the same time
+    with storage.locked_file(pool.path), pool.connection() as connection:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                "The deathcount database is at version {}, but this version of "
+                "the module only knows up to version {}.".format(
+                    version, SCHEMA_VERSION
+                )
+            )
+
+        for version in range(version, SCHEMA_VERSION):
+            logger.info(
+                "Migrating deathcount database to version {}.".format(version + 1)
+            )
+            # user_version is part of the database header, so it's only updated
+            # if the whole migration is committed. A failed migration is rolled
+            # back by the pool.
+            connection.executescript(
+                "BEGIN;\n{}\nPRAGMA user_version={};\nCOMMIT;".format(
+                    MIGRATIONS[version], version + 1
+                )
+            )
+
+
+migrate()
+
+# Cache-------------------------------------------------------------------------
+# Every command needs the channel's default game and most need a game's count,
+# so each channel's rows are read once and kept here. Changes are written to the
+# database and then applied to the cache.
+class ChannelData:
+    __slots__ = ("counts", "default_game", "nickname")
+
+    def __init__(self, counts: dict, default_game: str, nickname: str):
+        self.counts = counts
+        self.default_game = default_game
+        self.nickname = nickname
+
+
+channel_cache = {}
+
+
+def _channel_data(channel: str) -> ChannelData:
+    channel = channel.lower()
+    try:
+        return channel_cache[channel]
+    except KeyError:
+        pass
+
+    with pool.connection() as connection:
+        counts = dict(connection.execute(
+            "SELECT game, count FROM deathcount "
+            "WHERE channel=(?)",
+            (channel,)
+        ))
+
+        data = connection.execute(
+            "SELECT game FROM default_games "
+            "WHERE channel=(?)",
+            (channel,)
+        ).fetchone()
+        default_game = data[0] if data else ''
+
+        data = connection.execute(
+            "SELECT nickname FROM nicknames "
+            "WHERE channel=(?)",
+            (channel,)
+        ).fetchone()
+        nickname = data[0] if data else None
+
+    channel_cache[channel] = ChannelData(counts, default_game, nickname)
+    return channel_cache[channel]
+
+
+# Write-behind------------------------------------------------------------------
+# (channel, game) -> count that still has to be written
+pending_counts = {}
+# Rows for death_events that still have to be written
+pending_events = []
+flush_timer = None
+
+# pending_lock guards the pending changes and the timer. flush_lock makes
+# flushes run one at a time, so they're written in the order they were taken.
+pending_lock = threading.Lock()
+flush_lock = threading.Lock()
+
+
+def db_flush():
+    """Writes every pending death count and death event in a single
+    transaction.
+    """
+    global flush_timer
+
+    with flush_lock:
+        with pending_lock:
+            if flush_timer is not None:
+                flush_timer.cancel()
+                flush_timer = None
+
+            counts = list(pending_counts.items())
+            events = list(pending_events)
+            pending_counts.clear()
+            pending_events.clear()
+
+        if not counts and not events:
+            return
+
+        try:
+            with pool.connection() as connection:
+                connection.executemany(
+                    "UPDATE deathcount "
+                    "SET count=(?) "
+                    "WHERE channel=(?) AND game=(?)",
+                    [(count, channel, game) for (channel, game), count in counts]
+                )
+                _insert_events(connection, events)
+        except Exception:
+            # Keep them for the next flush, unless a newer count is waiting,
+            # and try again later even if nothing else changes
+            with pending_lock:
+                for key, count in counts:
+                    pending_counts.setdefault(key, count)
+                pending_events[:0] = events
+                _start_flush_timer()
+            raise
+
+    logger.debug("Wrote {} pending death counts and {} death events".format(
+        len(counts), len(events))
+    )
+
+
+def _insert_events(connection, events: list):
+    connection.executemany(
+        "INSERT INTO death_events "
+        "(ts, channel, game, amount, moderator, is_reset) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        events
+    )
+
+
+def _write_count(channel: str, game: str, count: int):
+    """Saves a game's new death count, now or later depending on WRITE_BEHIND.
+    The cache must already hold the new count.
+    """
+    if not WRITE_BEHIND:
+        with pool.connection() as connection:
+            connection.execute(
+                "UPDATE deathcount "
+                "SET count=(?) "
+                "WHERE channel=(?) AND game=(?)",
+                (count, channel, game)
+            )
+        return
+
+    with pending_lock:
+        pending_counts[(channel, game)] = count
+    _schedule_flush()
+
+
+def _start_flush_timer():
+    """Flushes in FLUSH_INTERVAL seconds, call with pending_lock held."""
+    global flush_timer
+
+    if flush_timer is None:
+        flush_timer = threading.Timer(FLUSH_INTERVAL, db_flush)
+        flush_timer.daemon = True
+        flush_timer.start()
+
+
+def _schedule_flush():
+    with pending_lock:
+        if max(len(pending_counts), len(pending_events)) < FLUSH_THRESHOLD:
+            _start_flush_timer()
+            return
+    db_flush()
+
+
+def set_write_policy(write_behind: bool=WRITE_BEHIND,
+                     flush_interval: float=FLUSH_INTERVAL,
+                     flush_threshold: int=FLUSH_THRESHOLD,
+                     journal_mode: str=JOURNAL_MODE,
+                     synchronous: str=SYNCHRONOUS):
+    """Changes how and when death counts are written. Pending changes are
+    written first, with the old settings.
+    """
+    global WRITE_BEHIND, FLUSH_INTERVAL, FLUSH_THRESHOLD
+
+    journal_mode = journal_mode.upper()
+    synchronous = synchronous.upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError("Unknown journal mode '{}'".format(journal_mode))
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError("Unknown synchronous level '{}'".format(synchronous))
+
+    db_flush()
+    with pending_lock:
+        WRITE_BEHIND = write_behind
+        FLUSH_INTERVAL = flush_interval
+        FLUSH_THRESHOLD = flush_threshold
+    pool.set_pragmas(
+        (("journal_mode", journal_mode), ("synchronous", synchronous))
+    )
+
 
 # Nickname management-----------------------------------------------------------
+@_locked
 def db_set_nickname(nickname: str, channel: str):
-    # Check if channel already has a nickname
-    cursor.execute(
-        "SELECT * FROM nicknames "
-        "WHERE channel=(?)",
-        (channel,)
-    )
-    data = cursor.fetchall()
-    if not data:
-        # Create a row for the channel and add their new nickname
-        cursor.execute(
+    db_flush()
+
+    with pool.connection() as connection:
+        connection.execute(
             "INSERT INTO nicknames "
-            "(nickname, channel) "
-            "VALUES (?, ?)",
-            (nickname, channel)
-        )
-    else:
-        # Update their nickname
-        cursor.execute(
-            "UPDATE nicknames "
-            "SET nickname=(?) "
-            "WHERE channel=(?)",
-            (nickname, channel.lower())
+            "(channel, nickname) "
+            "VALUES (?, ?) "
+            "ON CONFLICT (channel) DO UPDATE SET nickname=excluded.nickname",
+            (channel.lower(), nickname)
         )
-
-    connection.commit()
+    _channel_data(channel).nickname = nickname
 
 
+@_locked
 def db_get_streamer_nickname(channel: str) -> str:
     """Returns channel nickname, if not found it returns the channel's name
     """
-    cursor.execute(
-        "SELECT nickname FROM nicknames "
-        "WHERE channel=?",
-        (channel.lower(),)
-    )
-    data = cursor.fetchall()
-    if not data:
+    nickname = _channel_data(channel).nickname
+    if nickname is None:
         nickname = channel
-    else:
-        nickname = data[0][0]
 
     return nickname
 
 
 # Data management---------------------------------------------------------------
+@_locked
 def db_check_for_duplicate(game: str, channel: str) -> bool:
     """Checks if a game is already in the database for a channel
     """
-    cursor.execute(
-        "SELECT * FROM deathcount "
-        "WHERE channel=(?)AND game=(?)",
-        (channel.lower(), game.lower())
-    )
-    data = cursor.fetchall()
-    if len(data) > 0:
-        return False
-    else:
-        return True
+    return game.lower() not in _channel_data(channel).counts
 
 
+@_locked
 def db_check_game_exists(game: str, channel: str) -> bool:
     """Wrapper for db_check_for_duplicates, for readability
 
@@ -130,192 +433,320 @@ def db_check_game_exists(game: str, channel: str) -> bool:
     return not db_check_for_duplicate(game, channel)
 
 
+@_locked
 def db_get_death_count(game: str, channel: str) -> int:
     """Returns the deathcount for a game in a specific channel.
     """
-    cursor.execute(
-        "SELECT count FROM deathcount "
-        "WHERE channel=(?) AND game=(?)",
-        (channel.lower(), game.lower())
-    )
-    data = cursor.fetchall()
-    if not data:
-        return -1
-    else:
-        return data[0][0]
+    return _channel_data(channel).counts.get(game.lower(), -1)
 
 
+@_locked
 def db_get_game_count(channel: str):
     """Returns the number of games in a channel
     """
-    cursor.execute(
-        "SELECT game FROM deathcount "
-        "WHERE channel=(?)",
-        (channel.lower(),)
-    )
-    data = cursor.fetchall()
-    return len(data)
+    return len(_channel_data(channel).counts)
 
 
+@_locked
 def db_add_game(game: str, channel: str, set_default_game: bool=False) -> bool:
     """Adds a game to the database for a channel, does not allow duplicates
     """
     if not db_check_for_duplicate(game, channel):
         return False
     else:
-        if set_default_game:
-            default = "YES"
-        else:
-            default = "NO"
+        db_flush()
+        with pool.connection() as connection:
+            connection.execute(
+                "INSERT INTO deathcount "
+                "(channel, game, count) "
+                "VALUES (?, ?, 0) "
+                "ON CONFLICT (channel, game) DO NOTHING",
+                (channel.lower(), game.lower())
+            )
+            if set_default_game:
+                _save_default_game(connection, game, channel)
 
-        cursor.execute(
-            "INSERT INTO deathcount "
-            "(game, count, isdefault, channel) "
-            "VALUES (?, ?, ?, ?)",
-            (game.lower(), 0, default, channel.lower())
-        )
-        connection.commit()
+        data = _channel_data(channel)
+        data.counts[game.lower()] = 0
+        if set_default_game:
+            data.default_game = game.lower()
 
         return True
     
 
+@_locked
 def db_remove_game(game: str, channel: str) -> bool:
-    """Removes a game from the database, for a specific channel  
+    """Removes a game from the database, for a specific channel. Its death
+    events are kept, so adding the game back brings its history back too.
     """
     if db_check_game_exists(game, channel):
-        cursor.execute(
-            "DELETE FROM deathcount "
-            "WHERE channel=(?) AND game=(?)",
-            (channel.lower(), game.lower())
-        )
-        connection.commit()
+        db_flush()
+        with pool.connection() as connection:
+            for table in ("deathcount", "default_games"):
+                connection.execute(
+                    "DELETE FROM {} "
+                    "WHERE channel=(?) AND game=(?)".format(table),
+                    (channel.lower(), game.lower())
+                )
+
+        data = _channel_data(channel)
+        del data.counts[game.lower()]
+        if data.default_game == game.lower():
+            data.default_game = ''
         return True
     else:
         return False
 
 
-def db_increment_count(game: str, channel: str, amount: int) -> bool:
-    """Incremenets the deathcount of a game, for a specific channel
+@_locked
+def _change_count(game: str, channel: str, amount: int,
+                  moderator: str) -> int:
+    """Adds 'amount' (which may be negative) to a game's death count, never
+    going below zero, and logs the change as a death event. Returns the new
+    count, or -1 if the game isn't in the list of games.
     """
+    channel = channel.lower()
+    game = game.lower()
+    counts = _channel_data(channel).counts
 
-    if db_check_game_exists(game, channel):
-        cursor.execute(
+    if game not in counts:
+        return -1
+
+    # Events hold the change that was made, not the one asked for, so
+    # decrementing past zero doesn't log negative deaths.
+    now = time.time()
+    previous = counts[game]
+    if WRITE_BEHIND:
+        counts[game] = max(previous + amount, 0)
+        if counts[game] != previous:
+            with pending_lock:
+                pending_events.append(
+                    (now, channel, game, counts[game] - previous, moderator, 0)
+                )
+        _write_count(channel, game, counts[game])
+        return counts[game]
+
+    # A single statement both changes the count and returns the result
+    with pool.connection() as connection:
+        data = connection.execute(
             "UPDATE deathcount "
-            "SET count=count+(?) "
-            "WHERE channel=(?) AND game=(?)",
-            (amount, channel.lower(), game.lower())
-        )
-        connection.commit()
-        return True
-    else:
-        return False
+            "SET count=MAX(count + (?), 0) "
+            "WHERE channel=(?) AND game=(?) "
+            "RETURNING count",
+            (amount, channel, game)
+        ).fetchone()
+        if data is not None and data[0] != previous:
+            _insert_events(
+                connection,
+                [(now, channel, game, data[0] - previous, moderator, 0)]
+            )
 
+    if data is None:
+        del counts[game]
+        return -1
+    counts[game] = data[0]
+    return data[0]
 
-def db_decrement_count(game: str, channel: str, amount: int) -> bool:
-    if db_check_game_exists(game, channel):
-        count = db_get_death_count(game, channel)
-    
-        if count - amount < 0:
-            cursor.execute(
-                "UPDATE deathcount "
-                "SET count=(?) "
-                "WHERE channel=(?) AND game=(?)",
-                (0, channel.lower(), game.lower())
-            )
-            connection.commit()
-            return True
-        else:
-            cursor.execute(
-                "UPDATE deathcount "
-                "SET count=count-(?) "
-                "WHERE channel=(?) AND game=(?)",
-                (amount, channel.lower(), game.lower())
-            )
-            connection.commit()
-            return True
-    else:
-        return False
+
+@_locked
+def db_increment_count(game: str, channel: str, amount: int,
+                       moderator: str=None) -> int:
+    """Incremenets the deathcount of a game, for a specific channel
+
+    Returns the new death count, or -1 if the game isn't in the list of games.
+    """
+    return _change_count(game, channel, amount, moderator)
+
+
+@_locked
+def db_decrement_count(game: str, channel: str, amount: int,
+                       moderator: str=None) -> int:
+    """Returns the new death count, or -1 if the game isn't in the list of
+    games.
+    """
+    return _change_count(game, channel, -amount, moderator)
             
 
-def db_reset_count(game: str, channel: str) -> bool:
-    """Sets the counter to 0 for a game, in a specific channel
+@_locked
+def db_reset_count(game: str, channel: str, moderator: str=None) -> bool:
+    """Sets the counter to 0 for a game, in a specific channel. The reset is
+    logged as a death event taking the count back to zero, and stats count
+    the current stream from the last reset.
     """
-    if db_check_game_exists(game, channel):
-        cursor.execute(
+    channel = channel.lower()
+    counts = _channel_data(channel).counts
+    game = game.lower()
+
+    if game not in counts:
+        return False
+
+    event = (time.time(), channel, game, -counts[game], moderator, 1)
+    counts[game] = 0
+    if WRITE_BEHIND:
+        with pending_lock:
+            pending_events.append(event)
+        _write_count(channel, game, 0)
+        return True
+
+    with pool.connection() as connection:
+        connection.execute(
             "UPDATE deathcount "
-            "SET count=(?) "
+            "SET count=0 "
             "WHERE channel=(?) AND game=(?)",
-            (0, channel.lower(), game.lower())
+            (channel, game)
         )
-        connection.commit()
-        return True
-    else:
-        return False
+        _insert_events(connection, [event])
+    return True
+
+
+def _save_default_game(connection, game: str, channel: str):
+    connection.execute(
+        "INSERT INTO default_games "
+        "(channel, game) "
+        "VALUES (?, ?) "
+        "ON CONFLICT (channel) DO UPDATE SET game=excluded.game",
+        (channel.lower(), game.lower())
+    )
 
 
+@_locked
 def db_get_default_game(channel: str):
     """Returns the default game for a specific channel
     
     The default game is the game that will be used whenever a command
     is called without any game specified.
     """
-    cursor.execute(
-        "SELECT game FROM deathcount "
-        "WHERE channel=(?) AND isdefault=(?)",
-        (channel.lower(), "YES")
-    )
-    data = cursor.fetchall()
-
-    if len(data) == 0:
-        return ''
-    else:
-        return data[0][0]
+    return _channel_data(channel).default_game
 
 
+@_locked
 def db_set_default_game(game: str, channel:str) -> bool:
     """Marks a game as being the default for a specfic channel
     """
 
     if db_check_game_exists(game, channel):
-        # Unset previous default
-        cursor.execute(
-            "UPDATE deathcount "
-            "SET isdefault='NO' "
-            "WHERE channel=(?) AND isdefault=(?)",
-            (channel.lower(), "YES")
-        )
-        connection.commit()
-
-        # Set new game to default
-        cursor.execute(
-            "UPDATE deathcount "
-            "SET isdefault=(?) "
-            "WHERE channel=(?) AND game=(?)",
-            ("YES", channel.lower(), game.lower())
-        )
-        connection.commit()
+        db_flush()
+        with pool.connection() as connection:
+            _save_default_game(connection, game, channel)
+        _channel_data(channel).default_game = game.lower()
         return True
     else:
         return False
     
     
+# Statistics--------------------------------------------------------------------
+# Works out the streams from the gaps between death events and summarizes them
+# in a single query, so SQLite does the work rather than a loop over every row.
+#   events:     each event with the time since the event and death before it
+#   streams:    numbers the streams, a new one starts after a STREAM_GAP or at
+#               a reset
+#   bounds:     when each event's stream started
+#   per_stream: deaths, duration and longest gap between deaths per stream.
+#               A reset's amount undoes earlier streams, so isn't counted.
+# The result is the latest stream's row, along with the totals of all streams.
+STATS_QUERY = """
+WITH events AS (
+    SELECT ts, amount, is_reset,
+        ts - LAG(ts) OVER (ORDER BY ts) AS since_event,
+        ts - MAX(CASE WHEN amount > 0 THEN ts END) OVER (
+            ORDER BY ts ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+        ) AS since_death
+    FROM death_events
+    WHERE channel=:channel AND game=:game
+),
+streams AS (
+    SELECT *,
+        SUM(since_event IS NULL OR since_event > :gap OR is_reset) OVER (
+            ORDER BY ts ROWS UNBOUNDED PRECEDING
+        ) AS stream
+    FROM events
+),
+bounds AS (
+    SELECT *, MIN(ts) OVER (PARTITION BY stream) AS started
+    FROM streams
+),
+per_stream AS (
+    SELECT stream, started,
+        MAX(ts) AS last_event,
+        SUM(CASE WHEN is_reset THEN 0 ELSE amount END) AS deaths,
+        MAX(CASE
+            WHEN amount > 0 AND ts - since_death >= started THEN since_death
+        END) AS longest_streak
+    FROM bounds
+    GROUP BY stream
+)
+SELECT started, last_event, deaths,
+    (SELECT MAX(longest_streak) FROM per_stream),
+    (SELECT SUM(deaths) FROM per_stream),
+    (SELECT SUM(MAX(last_event - started, :minimum)) FROM per_stream)
+FROM per_stream
+ORDER BY stream DESC
+LIMIT 1
+"""
+
+
+class DeathStats:
+    __slots__ = (
+        "stream_deaths", "stream_per_hour", "longest_streak", "per_hour"
+    )
+
+    def __init__(self, stream_deaths: int, stream_per_hour: float,
+                 longest_streak: float, per_hour: float):
+        self.stream_deaths = stream_deaths
+        self.stream_per_hour = stream_per_hour
+        # Seconds, or None if there haven't been two deaths in one stream
+        self.longest_streak = longest_streak
+        self.per_hour = per_hour
+
+
+@_locked
+def db_get_death_stats(game: str, channel: str) -> DeathStats:
+    """Returns the death statistics of a game, or None if it has no deaths
+    logged. 'stream' stats are for the current stream, or the last one if
+    there's no death event within STREAM_GAP seconds.
+    """
+    db_flush()
+    rows = pool.execute(STATS_QUERY, {
+        "channel": channel.lower(), "game": game.lower(),
+        "gap": STREAM_GAP, "minimum": MIN_STATS_DURATION,
+    })
+    if not rows:
+        return None
+    data = rows[0]
+
+    started, last_event, deaths, longest_streak, total, streamed = data
+    now = time.time()
+    if now - last_event <= STREAM_GAP:
+        # Still streaming
+        last_event = now
+    duration = max(last_event - started, MIN_STATS_DURATION)
+
+    return DeathStats(
+        deaths, deaths * 3600 / duration, longest_streak,
+        total * 3600 / streamed
+    )
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return "{}m".format(minutes)
+    return "{}h {}m".format(minutes // 60, minutes % 60)
+
+
 def db_close_connection():
     logger.info(
         "Saving database and closing connection."
     )
-    cursor.close()
-    connection.close()
+    db_flush()
+    pool.close()
     
 
 # Command functions ------------------------------------------------------------
-def increment_deaths(user: IRC.User):
-
-    user_input = user.message.split(module_tools.DEFAULT_COMMAND_PREFIX, 1)[1]
-    parsed_input = re.findall(increment_regex, user_input)
-
-    if parsed_input[0]:
+def increment_deaths(user: IRC.User, amount: str=None):
+    if amount:
         try:
-            increment_by = int(parsed_input[0].strip())
+            increment_by = int(amount.strip())
         except ValueError:
             # I doubt this will ever launch, but I'd prefer not to have the bot
             # crash.
@@ -330,16 +761,17 @@ def increment_deaths(user: IRC.User):
     game = db_get_default_game(user.chatted_from)
 
     if not game:
-        user.send_message(
-            "No game has been set for the death counter. The streamer or a mod"
+        outbound.send_message(
+            user, "No game has been set for the death counter. The streamer or a mod"
             "can set the game by using '!deathcount set game <game>'"
         )
         return
 
 
-    if not db_increment_count(game, user.chatted_from, increment_by):
-        user.send_message(
-            "The game you've given is not in the list of games!"
+    deaths = db_increment_count(game, user.chatted_from, increment_by, user.name)
+    if deaths < 0:
+        outbound.send_message(
+            user, "The game you've given is not in the list of games!"
         )
     else:
         logger.info(
@@ -347,18 +779,17 @@ def increment_deaths(user: IRC.User):
             "{}.".format(user.name, increment_by, game, user.chatted_from)
         )
 
-        user.send_message(
-            "Death count has been incremented by {}, for the "
-            "game '{}'. RIP sfhSAD".format(increment_by, game)
+        outbound.send_message(
+            user, "Death count has been incremented by {}, for the "
+            "game '{}'. That's {} now. RIP sfhSAD".format(
+                increment_by, game, deaths
+            )
         )
     
-def decrement_deaths(user: IRC.User):
-    user_input = user.message.split(module_tools.DEFAULT_COMMAND_PREFIX, 1)[1]
-    parsed_input = re.findall(decrement_regex, user_input)
-
-    if parsed_input[0]:
+def decrement_deaths(user: IRC.User, amount: str=None):
+    if amount:
         try:
-            decrement_by = int(parsed_input[0].strip())
+            decrement_by = int(amount.strip())
         except ValueError:
             # I doubt this will ever launch, but I'd prefer not to have the bot
             # crash.
@@ -373,15 +804,16 @@ def decrement_deaths(user: IRC.User):
     game = db_get_default_game(user.chatted_from)
 
     if not game:
-        user.send_message(
-            "No game has been set for the death counter. The streamer or a mod"
+        outbound.send_message(
+            user, "No game has been set for the death counter. The streamer or a mod"
             "can set the game by using '!deathcount set game <game>'"
         )
 
 
-    if not db_decrement_count(game, user.chatted_from, decrement_by):
-        user.send_message(
-            "The game you've given is not in the list of games!"
+    deaths = db_decrement_count(game, user.chatted_from, decrement_by, user.name)
+    if deaths < 0:
+        outbound.send_message(
+            user, "The game you've given is not in the list of games!"
         )
     else:
         logger.info(
@@ -389,24 +821,24 @@ def decrement_deaths(user: IRC.User):
             "'{}'.".format(user.name, game, decrement_by, user.chatted_from)
         )
 
-        user.send_message(
-            "Death count has been decremented by {} for the game '{}'. "
-            "sfhOH".format(decrement_by, game)
+        outbound.send_message(
+            user, "Death count has been decremented by {} for the game '{}'. "
+            "That's {} now. sfhOH".format(decrement_by, game, deaths)
         )
 
 def reset_deaths(user: IRC.User):
     game = db_get_default_game(user.chatted_from)
 
     if not game:
-        user.send_message(
-            "No game has been set for the death counter. The streamer or a mod "
+        outbound.send_message(
+            user, "No game has been set for the death counter. The streamer or a mod "
             "can set the game by using '!deathcount set game <game>'"
         )
 
 
-    if not db_reset_count(game, user.chatted_from):
-        user.send_message(
-            "The game currently set is not in the database. This should not "
+    if not db_reset_count(game, user.chatted_from, user.name):
+        outbound.send_message(
+            user, "The game currently set is not in the database. This should not "
             "have happened... OhGod"
         )
     else:
@@ -414,24 +846,21 @@ def reset_deaths(user: IRC.User):
             game, user.chatted_from)
         )
         
-        user.send_message(
-            "Deaths have been reset to zero for the game '{}'. "
+        outbound.send_message(
+            user, "Deaths have been reset to zero for the game '{}'. "
             "sfhWOW".format(game)
         )
 
 
-def death_count(user: IRC.User):
-    user_input = user.message.split(module_tools.DEFAULT_COMMAND_PREFIX, 1)[1]
-    parsed_input = re.findall(deathcount_regex, user_input)[0]
-
-    if parsed_input:
-        game = parsed_input.strip().lower()
+def death_count(user: IRC.User, game: str=None):
+    if game:
+        game = game.strip().lower()
     else:
         game = db_get_default_game(user.chatted_from)
 
     if not game:
-        user.send_message(
-            "No game has been set for the death counter. The streamer or a mod "
+        outbound.send_message(
+            user, "No game has been set for the death counter. The streamer or a mod "
             "can set the game by using '!deathcount set game <game>'"
         )
         return
@@ -442,15 +871,15 @@ def death_count(user: IRC.User):
     streamer = db_get_streamer_nickname(user.chatted_from)
 
     if deaths > 1:
-        user.send_message(
-            "{} has died {} times. RIP sfhSAD".format(streamer, deaths)
+        outbound.send_message(
+            user, "{} has died {} times. RIP sfhSAD".format(streamer, deaths)
         )
     elif deaths == 1:
-        user.send_message("{} has died 1 time. RIP sfhSAD".format(streamer))
+        outbound.send_message(user, "{} has died 1 time. RIP sfhSAD".format(streamer))
     elif deaths == 0:
-        user.send_message("{} has yet to die! sfhOH".format(streamer))
+        outbound.send_message(user, "{} has yet to die! sfhOH".format(streamer))
     else:
-        user.send_message("{} is not in the list of games.".format(game))
+        outbound.send_message(user, "{} is not in the list of games.".format(game))
         return
 
     logger.info(
@@ -461,22 +890,65 @@ def death_count(user: IRC.User):
     )
 
     
-def add_game(user: IRC.User):
-    game = re.findall(add_game_regex, user.message)[0]
+def death_stats(user: IRC.User, game: str=None):
+    if game:
+        game = game.strip().lower()
+    else:
+        game = db_get_default_game(user.chatted_from)
+
+    if not game:
+        outbound.send_message(
+            user, "No game has been set for the death counter. The streamer or a mod "
+            "can set the game by using '!deathcount set game <game>'"
+        )
+        return
+
+    if not db_check_game_exists(game, user.chatted_from):
+        outbound.send_message(user, "{} is not in the list of games.".format(game))
+        return
+
+    stats = db_get_death_stats(game, user.chatted_from)
+    if stats is None:
+        outbound.send_message(
+            user, "No deaths have been counted for '{}' yet. sfhOH".format(game)
+        )
+        return
+
+    if stats.longest_streak is None:
+        streak = ""
+    else:
+        streak = " Longest time without dying: {}.".format(
+            format_duration(stats.longest_streak)
+        )
+
+    outbound.send_message(
+        user, "'{}': {} deaths this stream ({:.1f} an hour), {:.1f} an hour "
+        "overall.{} sfhSAD".format(
+            game, stats.stream_deaths, stats.stream_per_hour, stats.per_hour,
+            streak
+        )
+    )
+    logger.info(
+        "Read death stats for the game {}, in the channel {}.".format(
+            game, user.chatted_from
+        )
+    )
+
+
+def add_game(user: IRC.User, game: str):
 
     if not db_add_game(game, user.chatted_from):
-        user.send_message("'{}' is already in the list of games.".format(game))
+        outbound.send_message(user, "'{}' is already in the list of games.".format(game))
     else:
         logger.info(
             "{} has added the game '{}' to the channel '{}'".format(
                 user.name, game, user.chatted_from
             )
         )
-        user.send_message("'{}' is now in the list of games! sfhOH".format(game))
+        outbound.send_message(user, "'{}' is now in the list of games! sfhOH".format(game))
 
 
-def set_game(user: IRC.User):
-    game = re.findall(set_game_regex, user.message)[0]
+def set_game(user: IRC.User, game: str):
 
     if db_set_default_game(game, user.chatted_from):
         logger.info(
@@ -484,17 +956,16 @@ def set_game(user: IRC.User):
                 user.chatted_from, game, user.name
             )
         )
-        user.send_message("Game has been changed to {}. sfhOH".format(game))
+        outbound.send_message(user, "Game has been changed to {}. sfhOH".format(game))
     else:
-        user.send_message(
-            "{} is not in the list of games. If you'd like to add it to the "
+        outbound.send_message(
+            user, "{} is not in the list of games. If you'd like to add it to the "
             "list of games (and are a moderator), run '{}deathcount add game {}'."
             "".format(game, module_tools.DEFAULT_COMMAND_PREFIX, game)
         )
 
 
-def remove_game(user: IRC.User):
-    game = re.findall(remove_game_regex, user.message)[0]
+def remove_game(user: IRC.User, game: str):
 
     if db_remove_game(game, user.chatted_from):
         logger.info(
@@ -502,17 +973,16 @@ def remove_game(user: IRC.User):
                 user.name, game, user.chatted_from
             )
         )
-        user.send_message(
-            "{} has been removed from the list of games! "
+        outbound.send_message(
+            user, "{} has been removed from the list of games! "
             "RIP".format(game)
         )
 
     else:
-        user.send_message("{} is not in the list of games.".format(game))
+        outbound.send_message(user, "{} is not in the list of games.".format(game))
 
 
-def set_nickname(user: IRC.User):
-    nickname = re.findall(set_nickname_regex, user.message)[0]
+def set_nickname(user: IRC.User, nickname: str):
 
     db_set_nickname(nickname, user.chatted_from)
     logger.info(
@@ -520,18 +990,19 @@ def set_nickname(user: IRC.User):
             user.name, user.chatted_from, nickname
         )
     )
-    user.send_message("Nickname has been set to '{}'".format(nickname))
+    outbound.send_message(user, "Nickname has been set to '{}'".format(nickname))
 
 
 # Registering Commands----------------------------------------------------------
-module_tools.register_command(increment_regex, increment_deaths, "moderator", mod_cooldown=15)
-module_tools.register_command(decrement_regex, decrement_deaths, "moderator", mod_cooldown=15)
-module_tools.register_command(deathcount_regex, death_count)
-module_tools.register_command("deathcount reset", reset_deaths, "broadcaster")
-module_tools.register_command(remove_game_regex, remove_game,"moderator")
-module_tools.register_command(add_game_regex, add_game, "moderator", mod_cooldown=15)
-module_tools.register_command(set_game_regex, set_game,  "moderator")
-module_tools.register_command(set_nickname_regex, set_nickname, "moderator")
+router.register_command(increment_regex, increment_deaths, "moderator", mod_cooldown=15)
+router.register_command(decrement_regex, decrement_deaths, "moderator", mod_cooldown=15)
+router.register_command(deathcount_regex, death_count)
+router.register_command("deathcount reset", reset_deaths, "broadcaster")
+router.register_command(stats_regex, death_stats, everyone_cooldown=10)
+router.register_command(remove_game_regex, remove_game,"moderator")
+router.register_command(add_game_regex, add_game, "moderator", mod_cooldown=15)
+router.register_command(set_game_regex, set_game,  "moderator")
+router.register_command(set_nickname_regex, set_nickname, "moderator")
 
 # Reserving command names
 module_tools.reserve_general_commands(RESERVED_COMMAND_NAMES)
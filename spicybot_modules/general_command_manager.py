@@ -7,15 +7,22 @@ It will manage configuration of every other command module
 Second:
 It will manage local commands, simple response commands
 that are common in just about every bot.
+
+Each channel has its own commands. To move a channel's commands over from
+another bot, put them in "command_imports/<channel>.json" in the module's
+storage directory and have the broadcaster run '!commands import'. The file
+holds a list of objects with a "name" and "response", and optionally a "level"
+and "cooldown". '!commands export' writes the channel's commands to
+"command_exports/<channel>.json" in the same format.
 """
-# TODO: I just realized something pretty terrible... Registering commands with
-#       the create_command() function will make the command available on every
-#       channel this bot is on... So really, I can't do it this way. Instead I
-#       should use the data from module_tools
 
 # Imports---------------------------------------------------------------------
+import os
 import re
+import json
+import threading
 import spicytwitch
+from . import cooldowns, outbound, router, storage
 
 
 # Global Variables------------------------------------------------------------
@@ -25,13 +32,20 @@ RESERVED_COMMAND_NAMES = [
     "commands"
 ]
 
+DATABASE_NAME = "general_commands.sqlite"
+DEFAULT_LEVEL = "everyone"
+DEFAULT_COOLDOWN = 30
+
+IMPORT_DIRECTORY = "command_imports"
+EXPORT_DIRECTORY = "command_exports"
+
 # Regex-----------------------------------------------------------------------
 # TODO: I believe I need to do a check at the start of each regex.
 #       I'll check for a character as that's what'll be used to denote a call.
-add_regex = r"commands add( --\w+=\w+)* {}(\w+) (.+)".format(
+add_regex = r"commands add((?: --\w+=\w+)*) {}(\w+) (.+)".format(
     module_tools.DEFAULT_COMMAND_PREFIX
 )
-edit_regex = r"commands edit (--\w+=\w+)? {}(\w+) (.+)".format(
+edit_regex = r"commands edit((?: --\w+=\w+)*) {}(\w+)(?: (.+))?".format(
     module_tools.DEFAULT_COMMAND_PREFIX
 )
 delete_regex = r"commands (delete|remove) {}(\w+)".format(
@@ -40,101 +54,421 @@ delete_regex = r"commands (delete|remove) {}(\w+)".format(
 rename_regex = r"commands rename {prefix}(\w+) {prefix}(\w+)".format(
     prefix=module_tools.DEFAULT_COMMAND_PREFIX
 )
+import_regex = r"commands import"
+export_regex = r"commands export"
+
+name_regex = re.compile(r"\w+")
 
 # Module Registration-----------------------------------------------------------
 spicytwitch.bot.modules.register_command_module()
 logger = spicytwitch.log_tools.create_logger()
 
 
-# Database setup----------------------------------------------------------------
-# TODO: Setup storage location in Bot.modules
+# Command store-----------------------------------------------------------------
+class Command:
+    __slots__ = ("name", "response", "level", "rank", "cooldown")
+
+    def __init__(self, name: str, response: str, level: str, cooldown: float):
+        self.name = name
+        self.response = response
+        self.level = level
+        self.rank = cooldowns.level_rank(level)
+        self.cooldown = cooldown
+
+
+class CommandStore:
+    """Keeps each channel's commands in a database, and in memory once the
+    channel has been used, so looking a command up never touches the disk.
+
+    Command names are kept in lowercase. Cooldowns are tracked by cooldowns.py.
+    """
+
+    def __init__(self, path: str):
+        self.pool = storage.open_pool(path)
+        with self.pool.connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS commands ("
+                "channel TEXT NOT NULL, name TEXT NOT NULL, "
+                "response TEXT NOT NULL, level TEXT NOT NULL, "
+                "cooldown REAL NOT NULL, "
+                "PRIMARY KEY (channel, name)) WITHOUT ROWID"
+            )
+
+        # Channel -> {name: Command}
+        self.channels = {}
+        self.lock = threading.RLock()
+
+    def _commands(self, channel: str) -> dict:
+        try:
+            return self.channels[channel]
+        except KeyError:
+            pass
+
+        with self.lock:
+            if channel not in self.channels:
+                self.channels[channel] = {
+                    row[0]: Command(*row) for row in self.pool.execute(
+                        "SELECT name, response, level, cooldown FROM commands "
+                        "WHERE channel=?",
+                        (channel,)
+                    )
+                }
+            return self.channels[channel]
+
+    def get(self, channel: str, name: str) -> Command:
+        """Returns a channel's command, or None if it has no such command."""
+        return self._commands(channel).get(name.lower())
+
+    def add(self, channel: str, name: str, response: str,
+            level: str=DEFAULT_LEVEL, cooldown: float=DEFAULT_COOLDOWN) -> bool:
+        """Returns False if the channel already has a command by that name."""
+        name = name.lower()
+        with self.lock:
+            commands = self._commands(channel)
+            if name in commands:
+                return False
+
+            with self.pool.connection() as connection:
+                connection.execute(
+                    "INSERT INTO commands "
+                    "(channel, name, response, level, cooldown) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (channel, name, response, level, cooldown)
+                )
+            commands[name] = Command(name, response, level, cooldown)
+            return True
+
+    def edit(self, channel: str, name: str, response: str=None,
+             level: str=None, cooldown: float=None) -> bool:
+        """Changes the parts of a command that aren't None. Returns False if
+        the channel has no command by that name.
+        """
+        name = name.lower()
+        with self.lock:
+            old = self._commands(channel).get(name)
+            if old is None:
+                return False
+
+            new = Command(
+                name,
+                old.response if response is None else response,
+                old.level if level is None else level,
+                old.cooldown if cooldown is None else cooldown
+            )
+            with self.pool.connection() as connection:
+                connection.execute(
+                    "UPDATE commands SET response=?, level=?, cooldown=? "
+                    "WHERE channel=? AND name=?",
+                    (new.response, new.level, new.cooldown, channel, name)
+                )
+            self.channels[channel][name] = new
+            return True
+
+    def delete(self, channel: str, name: str) -> bool:
+        name = name.lower()
+        with self.lock:
+            if name not in self._commands(channel):
+                return False
+
+            with self.pool.connection() as connection:
+                connection.execute(
+                    "DELETE FROM commands WHERE channel=? AND name=?",
+                    (channel, name)
+                )
+            del self.channels[channel][name]
+            cooldowns.forget(channel, name)
+            return True
+
+    def rename(self, channel: str, old_name: str, new_name: str) -> bool:
+        """Returns False if there's no command called 'old_name', or there
+        already is one called 'new_name'.
+        """
+        old_name = old_name.lower()
+        new_name = new_name.lower()
+        with self.lock:
+            commands = self._commands(channel)
+            if old_name not in commands or new_name in commands:
+                return False
+
+            with self.pool.connection() as connection:
+                connection.execute(
+                    "UPDATE commands SET name=? WHERE channel=? AND name=?",
+                    (new_name, channel, old_name)
+                )
+            command = commands.pop(old_name)
+            command.name = new_name
+            commands[new_name] = command
+            cooldowns.forget(channel, old_name)
+            return True
+
+    def import_commands(self, channel: str, commands: list) -> int:
+        """Adds a list of Commands to a channel in a single transaction,
+        replacing any by the same names. Returns the number imported.
+        """
+        with self.lock:
+            with self.pool.connection() as connection:
+                connection.executemany(
+                    "INSERT INTO commands "
+                    "(channel, name, response, level, cooldown) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (channel, name) DO UPDATE SET "
+                    "response=excluded.response, level=excluded.level, "
+                    "cooldown=excluded.cooldown",
+                    [
+                        (channel, command.name, command.response,
+                         command.level, command.cooldown)
+                        for command in commands
+                    ]
+                )
+            # Only update the cache once the transaction went through
+            loaded = self._commands(channel)
+            for command in commands:
+                loaded[command.name] = command
+            return len(commands)
+
+    def export_commands(self, channel: str) -> list:
+        """Returns a channel's Commands, sorted by name."""
+        with self.lock:
+            return sorted(
+                self._commands(channel).values(),
+                key=lambda command: command.name
+            )
+
+    def close(self):
+        self.pool.close()
+
+
 storage_location = module_tools.get_storage_directory()
-database = spicytwitch.bot.modules.GeneralCommandDatabase(
-    __name__, storage_location
-)
+database = CommandStore(os.path.join(storage_location, DATABASE_NAME))
 
 def _close_database():
     database.close()
+
+
+# Options and files-------------------------------------------------------------
+def parse_options(options: str) -> dict:
+    """Turns " --userlevel=moderator --cooldown=5" into a dict."""
+    parsed = {}
+    for option in options.split():
+        key, _, value = option.lstrip('-').partition('=')
+        parsed[key.lower()] = value
+    return parsed
+
+
+def option_level(options: dict) -> str:
+    """Returns the user level from parsed options, or None if not given or not
+    a valid level.
+    """
+    level = options.get('userlevel', options.get('level'))
+    if level is None or level.lower() not in module_tools.USER_LEVELS:
+        return None
+    return level.lower()
+
+
+def option_cooldown(options: dict) -> float:
+    try:
+        return max(float(options['cooldown']), 0.0)
+    except (KeyError, ValueError):
+        return None
+
+
+def name_in_use(name: str) -> bool:
+    """True if a name is taken by one of the bot's own commands."""
+    return (module_tools.check_if_command_exists(name, ignore_casing=True)
+            or router.command_exists(name.lower()))
+
+
+def load_command_file(path: str) -> tuple:
+    """Reads a list of commands from a JSON file. Returns the valid Commands,
+    and the number of entries that were skipped.
+    """
+    with open(path, 'r', encoding='utf-8') as command_file:
+        entries = json.load(command_file)
+    if not isinstance(entries, list):
+        raise ValueError("Expected a list of commands")
+
+    commands = {}
+    skipped = 0
+    for entry in entries:
+        try:
+            name = str(entry['name']).lstrip(module_tools.DEFAULT_COMMAND_PREFIX)
+            response = str(entry['response']).strip()
+        except (TypeError, KeyError):
+            skipped += 1
+            continue
+
+        if not name_regex.fullmatch(name) or not response or name_in_use(name):
+            skipped += 1
+            continue
+
+        options = {
+            key: str(entry[key]) for key in ('level', 'cooldown') if key in entry
+        }
+        level = option_level(options) or DEFAULT_LEVEL
+        cooldown = option_cooldown(options)
+        if cooldown is None:
+            cooldown = DEFAULT_COOLDOWN
+
+        # A later entry with the same name replaces an earlier one
+        commands[name.lower()] = Command(name.lower(), response, level, cooldown)
+    return list(commands.values()), skipped
+
+
+def save_command_file(path: str, commands: list):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as command_file:
+        json.dump(
+            [
+                {"name": command.name, "response": command.response,
+                 "level": command.level, "cooldown": command.cooldown}
+                for command in commands
+            ],
+            command_file, indent=2, ensure_ascii=False
+        )
+    os.replace(temporary_path, path)
    
 
 # Command Functions-------------------------------------------------------------
-def commands_add(user: IRC.User):
-    parsed_input = re.findall(add_regex, user.message)[0]
-    print('Parsed: {}'.format(parsed_input))
+def commands_add(user: IRC.User, options: str, command_name: str,
+                 command_response: str):
+    options = parse_options(options)
 
-    options = {}
-    if len(parsed_input) >= 3:
-        print(parsed_input[:-2])
-        for option in parsed_input[:-2]:
-            option_value = option.split('=', 1)
+    if name_in_use(command_name):
+        outbound.send_message(user, "The name '{}' is already in use.".format(command_name))
+    else:
+        level = option_level(options) or DEFAULT_LEVEL
+        cooldown = option_cooldown(options)
+        if cooldown is None:
+            cooldown = DEFAULT_COOLDOWN
 
-            if len(option_value) < 2:
-                continue
+        if not database.add(
+            user.chatted_from, command_name, command_response, level, cooldown
+        ):
+            outbound.send_message(user, "The name '{}' is already in use".format(command_name))
+        else:
+            logger.info("{} added command '{}' to channel '{}'".format(
+                user.name, command_name, user.chatted_from
+            ))
+            outbound.send_message(user, "Command '{}' has been created PogChamp".format(command_name))
 
-            options[option[0].split('-', 2)[-1].lower()] = option_value[1]
-    
-    print(parsed_input)
 
-    command_name = parsed_input[-2]
-    command_response = parsed_input[-1]
+def commands_edit(user: IRC.User, options: str, command_name: str,
+                  command_response: str=None):
+    options = parse_options(options)
+    level = option_level(options)
+    cooldown = option_cooldown(options)
 
-    if module_tools.check_if_command_exists(command_name, ignore_casing=True):
-        user.send_message("The name '{}' is already in use.".format(command_name))
+    if command_response is None and level is None and cooldown is None:
+        outbound.send_message(
+            user, "Give a new response, --userlevel= or --cooldown= to change."
+        )
+    elif not database.edit(
+        user.chatted_from, command_name, command_response, level, cooldown
+    ):
+        outbound.send_message(user, "There is no command '{}'.".format(command_name))
     else:
-        if 'userlevel' in options.keys():
-            level = options['userlevel']
-            if level.lower() not in module_tools.USER_LEVELS:
-                level = 'everyone'
-            print(level)
-        else:
-            level = 'everyone'
+        logger.info("{} edited command '{}' in channel '{}'".format(
+            user.name, command_name, user.chatted_from
+        ))
+        outbound.send_message(user, "Command '{}' has been edited.".format(command_name))
 
-        if "cooldown" in options.keys():
-            cooldown = options['cooldown']
-        else:
-            cooldown = 30
 
-        if not database.add_command(
-            command_name, command_response, cooldown, level, user.chatted_from
-        ):
-            user.send_message("The name '{}' is already in use".format(command_name))
-        else:
-            user.send_message("Command '{}' has been created PogChamp".format(command_name))
+def commands_delete(user: IRC.User, verb: str, command_name: str):
+    if not database.delete(user.chatted_from, command_name):
+        outbound.send_message(user, "There is no command '{}'.".format(command_name))
+    else:
+        logger.info("{} deleted command '{}' from channel '{}'".format(
+            user.name, command_name, user.chatted_from
+        ))
+        outbound.send_message(user, "Command '{}' has been deleted.".format(command_name))
+
+
+def commands_rename(user: IRC.User, old_name: str, new_name: str):
+    if name_in_use(new_name):
+        outbound.send_message(user, "The name '{}' is already in use.".format(new_name))
+    elif not database.rename(user.chatted_from, old_name, new_name):
+        outbound.send_message(
+            user, "Either there is no command '{}', or '{}' is already "
+            "taken.".format(old_name, new_name)
+        )
+    else:
+        logger.info("{} renamed command '{}' to '{}' in channel '{}'".format(
+            user.name, old_name, new_name, user.chatted_from
+        ))
+        outbound.send_message(
+            user, "Command '{}' is now '{}'.".format(old_name, new_name)
+        )
+
+
+def commands_import(user: IRC.User):
+    path = os.path.join(
+        storage_location, IMPORT_DIRECTORY, "{}.json".format(user.chatted_from)
+    )
+    try:
+        commands, skipped = load_command_file(path)
+    except FileNotFoundError:
+        outbound.send_message(user, "There's no command file to import.")
+        return
+    except ValueError as error:
+        logger.warning("Could not read '{}': {}".format(path, error))
+        outbound.send_message(user, "The command file could not be read.")
+        return
+
+    imported = database.import_commands(user.chatted_from, commands)
+    logger.info("{} imported {} commands into channel '{}', skipped {}".format(
+        user.name, imported, user.chatted_from, skipped
+    ))
+    outbound.send_message(
+        user, "Imported {} commands, skipped {}.".format(imported, skipped)
+    )
+
+
+def commands_export(user: IRC.User):
+    path = os.path.join(
+        storage_location, EXPORT_DIRECTORY, "{}.json".format(user.chatted_from)
+    )
+    commands = database.export_commands(user.chatted_from)
+    save_command_file(path, commands)
+    logger.info("Exported {} commands from channel '{}' to '{}'".format(
+        len(commands), user.chatted_from, path
+    ))
+    outbound.send_message(user, "Exported {} commands.".format(len(commands)))
 
 
 # Registering commands----------------------------------------------------------
-module_tools.register_command(add_regex, commands_add, "moderator", mod_cooldown=3)
+router.register_command(add_regex, commands_add, "moderator", mod_cooldown=3)
+router.register_command(edit_regex, commands_edit, "moderator", mod_cooldown=3)
+router.register_command(delete_regex, commands_delete, "moderator", mod_cooldown=3)
+router.register_command(rename_regex, commands_rename, "moderator", mod_cooldown=3)
+router.register_command(import_regex, commands_import, "broadcaster")
+router.register_command(export_regex, commands_export, "broadcaster")
 module_tools.reserve_general_commands(RESERVED_COMMAND_NAMES)
 module_tools.register_shutdown_function(_close_database)
 
 
 # Outer interface---------------------------------------------------------------
-# NOTE: I should update the GeneralCommandModule to allow for editing.
 def manage_general_commands(user: IRC.User) -> bool:
-    try:
-        command_name = user.message.split(module_tools.DEFAULT_COMMAND_PREFIX, 1)[1]
-    except IndexError:
-        logger.info("Was not a command")
+    """Sends the response of a channel's command. Returns False if the message
+    wasn't one of the channel's commands.
+    """
+    if not user.message.startswith(module_tools.DEFAULT_COMMAND_PREFIX):
         return False
 
-    database.initialize_channel(user.chatted_from)
-    response =  database.get_response(command_name, user.chatted_from)
-    if not response:
-        logger.info("Was not a command in the general database")
+    command_name = user.message[len(module_tools.DEFAULT_COMMAND_PREFIX):]
+    command = database.get(user.chatted_from, command_name.split(' ', 1)[0])
+    if command is None:
         return False
 
-    user_level = database.get_user_level(command_name, user.chatted_from)
-    if not module_tools.default_check_user_level(user_level, user):
-        logger.info("Userlevel did not check out")
-        return False
+    if cooldowns.user_rank(user) < command.rank:
+        logger.debug("Userlevel did not check out")
+        return True
 
-    if not database.check_cooldown(command_name, user.chatted_from):
-        logger.info("Cooldown did not check out")
-        return False
+    if not cooldowns.check(user.chatted_from, command.name,
+                           cooldowns.GROUP_EVERYONE, command.cooldown):
+        logger.debug("Cooldown did not check out")
+        return True
 
-    IRC.chat(response, user.chatted_from)
-    database.mark_cooldown(command_name, user.chatted_from)
-    logger.info("Sent command '{}' to channel '{}'".format(command_name, user.chatted_from))
+    outbound.chat(command.response, user.chatted_from)
+    logger.info("Sent command '{}' to channel '{}'".format(command.name, user.chatted_from))
     return True
-
-   
@@ -0,0 +1,316 @@
+"""
+Description:
+Queues every outgoing chat message and sends them at a pace twitch will accept.
+
+Twitch limits how many messages an account may send, both overall and per
+channel, and going over those limits gets the bot throttled everywhere. Rather
+than calling IRC.chat() or user.send_message() directly, modules call chat() or
+send_message() from here. Messages are kept in priority lanes, so that admin
+notices go out before quote replies, and identical messages queued within a
+short window of each other are only sent once.
+"""
+
+# Imports-----------------------------------------------------------------------
+import time
+import threading
+from collections import OrderedDict, deque
+import spicytwitch
+from . import cooldowns
+
+# Global Variables--------------------------------------------------------------
+IRC = spicytwitch.irc
+
+# Priority lanes, messages in a lower lane are always sent first.
+PRIORITY_ADMIN = 0
+PRIORITY_MODERATOR = 1
+PRIORITY_NORMAL = 2
+PRIORITY_NAMES = ["admin", "moderator", "normal"]
+
+# Twitch allows 20 messages every 30 seconds for an account that is not a
+# moderator. The per channel limit keeps a single busy channel from using up
+# the whole global allowance.
+GLOBAL_MESSAGES = 20
+GLOBAL_PERIOD = 30.0
+CHANNEL_MESSAGES = 1
+CHANNEL_PERIOD = 1.0
+
+# Identical messages queued within this many seconds of each other are merged.
+COALESCE_WINDOW = 5.0
+
+# Number of recent sends kept for reporting latency.
+LATENCY_SAMPLES = 200
+
+# Seconds flush() waits on top of how long the queue should take to send.
+FLUSH_MARGIN = 10.0
+
+logger = spicytwitch.log_tools.create_logger()
+
+
+# Sliding window----------------------------------------------------------------
+class SlidingWindow:
+    """Allows up to 'capacity' sends in any 'period' seconds, by keeping the
+    times of the last 'capacity' sends.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+        self.sends = deque(maxlen=capacity)
+
+    def expire(self, now: float):
+        while self.sends and self.sends[0] <= now - self.period:
+            self.sends.popleft()
+
+    def wait_time(self, now: float) -> float:
+        """Returns how many seconds until another send is allowed."""
+        self.expire(now)
+        if len(self.sends) < self.capacity:
+            return 0.0
+        return self.sends[0] + self.period - now
+
+    def take(self, now: float):
+        self.sends.append(now)
+
+    def drain_time(self, count: int, now: float) -> float:
+        """Returns how many seconds until 'count' more sends are allowed."""
+        self.expire(now)
+        free = self.capacity - len(self.sends)
+        if count <= free:
+            return 0.0
+        # Sends fill the free slots now, then each waits for the send
+        # 'capacity' places before it to leave the window.
+        times = list(self.sends) + [now] * free
+        extra = count - free - 1
+        return (
+            times[extra % self.capacity]
+            + self.period * (extra // self.capacity + 1) - now
+        )
+
+
+# Scheduler---------------------------------------------------------------------
+class _Message:
+    __slots__ = ("channel", "key", "send", "queued_at")
+
+    def __init__(self, channel: str, key: tuple, send, queued_at: float):
+        self.channel = channel
+        self.key = key
+        self.send = send
+        self.queued_at = queued_at
+
+
+class OutboundScheduler:
+    def __init__(self):
+        self.global_window = SlidingWindow(GLOBAL_MESSAGES, GLOBAL_PERIOD)
+        self.channel_limit = (CHANNEL_MESSAGES, CHANNEL_PERIOD)
+        self.channel_windows = {}
+
+        # One ordered dict of channel -> deque per lane. Channels are moved to
+        # the end once they've sent, so channels in a lane take turns.
+        self.lanes = [OrderedDict() for _ in PRIORITY_NAMES]
+        self.pending = {}
+
+        self.condition = threading.Condition()
+        self.worker = None
+        self.sending = False
+
+        self.sent = 0
+        self.coalesced = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def set_limits(self, global_messages: int=GLOBAL_MESSAGES,
+                   global_period: float=GLOBAL_PERIOD,
+                   channel_messages: int=CHANNEL_MESSAGES,
+                   channel_period: float=CHANNEL_PERIOD):
+        with self.condition:
+            self.global_window = SlidingWindow(global_messages, global_period)
+            self.channel_limit = (channel_messages, channel_period)
+            self.channel_windows.clear()
+
+    def queue(self, channel: str, key: tuple, send, priority: int) -> bool:
+        """Queues a send function, returns False if it was merged with an
+        identical message that is already waiting.
+        """
+        now = time.monotonic()
+        with self.condition:
+            queued_at = self.pending.get(key)
+            if queued_at is not None and now - queued_at <= COALESCE_WINDOW:
+                self.coalesced += 1
+                return False
+
+            self.pending[key] = now
+            lane = self.lanes[priority]
+            if channel not in lane:
+                lane[channel] = deque()
+            lane[channel].append(_Message(channel, key, send, now))
+
+            if self.worker is None:
+                self.worker = threading.Thread(
+                    target=self._run, name="outbound", daemon=True
+                )
+                self.worker.start()
+            self.condition.notify()
+            return True
+
+    def _channel_window(self, channel: str) -> SlidingWindow:
+        try:
+            return self.channel_windows[channel]
+        except KeyError:
+            window = SlidingWindow(*self.channel_limit)
+            self.channel_windows[channel] = window
+            return window
+
+    def _next_message(self, now: float):
+        """Returns the next message that may be sent, or how long to wait."""
+        wait = self.global_window.wait_time(now)
+        if wait:
+            return None, wait
+
+        wait = None
+        for lane in self.lanes:
+            for channel, messages in lane.items():
+                channel_wait = self._channel_window(channel).wait_time(now)
+                if not channel_wait:
+                    message = messages.popleft()
+                    if messages:
+                        lane.move_to_end(channel)
+                    else:
+                        del lane[channel]
+                    return message, 0.0
+                if wait is None or channel_wait < wait:
+                    wait = channel_wait
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                message, wait = self._next_message(now)
+                if message is None:
+                    self.condition.wait(wait)
+                    continue
+
+                self.global_window.take(now)
+                self._channel_window(message.channel).take(now)
+                if self.pending.get(message.key) == message.queued_at:
+                    del self.pending[message.key]
+                self.sending = True
+
+            try:
+                message.send()
+                sent = True
+            except Exception:
+                logger.exception(
+                    "Failed to send message to channel '{}'".format(message.channel)
+                )
+                sent = False
+
+            with self.condition:
+                if sent:
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - message.queued_at)
+                self.sending = False
+                self.condition.notify_all()
+
+    def queue_depth(self) -> dict:
+        with self.condition:
+            return {
+                name: sum(len(messages) for messages in lane.values())
+                for name, lane in zip(PRIORITY_NAMES, self.lanes)
+            }
+
+    def get_stats(self) -> dict:
+        """Returns the queue depth per lane and recent send latency in seconds."""
+        depth = self.queue_depth()
+        with self.condition:
+            latencies = sorted(self.latencies)
+            sent = self.sent
+            coalesced = self.coalesced
+
+        if latencies:
+            average = sum(latencies) / len(latencies)
+            highest = latencies[-1]
+        else:
+            average = highest = 0.0
+
+        return {
+            "queued": depth,
+            "sent": sent,
+            "coalesced": coalesced,
+            "average_latency": average,
+            "max_latency": highest,
+        }
+
+    def drain_time(self) -> float:
+        """Returns how many seconds the queued messages should take to send,
+        going by the global and per channel limits.
+        """
+        with self.condition:
+            now = time.monotonic()
+            channels = {}
+            for lane in self.lanes:
+                for channel, messages in lane.items():
+                    channels[channel] = channels.get(channel, 0) + len(messages)
+
+            drain = self.global_window.drain_time(sum(channels.values()), now)
+            for channel, queued in channels.items():
+                drain = max(
+                    drain, self._channel_window(channel).drain_time(queued, now)
+                )
+            return drain
+
+    def flush(self, timeout: float=None) -> bool:
+        """Waits until every queued message is sent, or until the timeout.
+        Without a timeout, waits for as long as the queue should take to send
+        plus FLUSH_MARGIN.
+
+        Returns True if the queue was emptied.
+        """
+        if timeout is None:
+            timeout = self.drain_time() + FLUSH_MARGIN
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while any(self.lanes) or self.sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+scheduler = OutboundScheduler()
+
+
+# Outer interface---------------------------------------------------------------
+def chat(message: str, channel: str, priority: int=PRIORITY_NORMAL) -> bool:
+    """Queues a message to be sent to a channel."""
+    return scheduler.queue(
+        channel, (channel, None, message),
+        lambda: IRC.chat(message, channel), priority
+    )
+
+
+def send_message(user: IRC.User, message: str, priority: int=None) -> bool:
+    """Queues a reply to a user, in the channel they chatted from. Replies to
+    moderators and the broadcaster go in the moderator lane by default.
+    """
+    if priority is None:
+        if cooldowns.user_rank(user) >= cooldowns.MODERATOR:
+            priority = PRIORITY_MODERATOR
+        else:
+            priority = PRIORITY_NORMAL
+    return scheduler.queue(
+        user.chatted_from, (user.chatted_from, user.name, message),
+        lambda: user.send_message(message), priority
+    )
+
+
+def set_limits(*args, **kwargs):
+    scheduler.set_limits(*args, **kwargs)
+
+
+def get_stats() -> dict:
+    return scheduler.get_stats()
+
+
+def flush(timeout: float=None) -> bool:
+    return scheduler.flush(timeout)
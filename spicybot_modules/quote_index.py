@@ -0,0 +1,177 @@
+"""
+Description:
+Indexes kept over a channel's quotes, on top of QuoteStore.
+
+SimilarityIndex finds quotes that are nearly the same as a new one. Each quote
+is broken into overlapping three letter shingles and given a MinHash signature,
+which is split into bands. Quotes that share any band are candidates, and only
+candidates have their actual similarity (Jaccard index of the shingles)
+computed. Checking a new quote therefore costs the same no matter how many
+quotes a channel has.
+
+SearchIndex maps each word to the set of quotes containing it. A search returns
+the quotes containing every searched word, found by starting with the word in
+the fewest quotes, so common words don't slow searches down.
+"""
+
+# Imports-----------------------------------------------------------------------
+import re
+import heapq
+from random import Random
+
+# Global Variables--------------------------------------------------------------
+SHINGLE_SIZE = 3
+
+# 16 hashes in 4 bands of 4. Quotes that are 70% similar share a band about
+# 70% of the time, quotes that are 90% similar almost always do.
+SIGNATURE_SIZE = 16
+BAND_SIZE = 4
+SIMILARITY_THRESHOLD = 0.7
+
+# Each signature value is the smallest of the shingles' hashes XORed with one of
+# these salts. Hashes are cut down to 31 bits so they stay small ints.
+HASH_MASK = 0x7fffffff
+_SALTS = [Random(index).getrandbits(31) for index in range(SIGNATURE_SIZE)]
+
+word_regex = re.compile(r"\w+")
+
+
+def shingles(text: str) -> set:
+    """Returns the set of overlapping SHINGLE_SIZE letter pieces of a text,
+    ignoring case and repeated whitespace.
+    """
+    text = ' '.join(text.lower().split())
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def similarity(first: set, second: set) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def band_keys(text_shingles: set) -> list:
+    hashes = [hash(shingle) & HASH_MASK for shingle in text_shingles]
+    signature = [min([value ^ salt for value in hashes]) for salt in _SALTS]
+    return [
+        hash((band, tuple(signature[band:band + BAND_SIZE])))
+        for band in range(0, SIGNATURE_SIZE, BAND_SIZE)
+    ]
+
+
+# Similarity index--------------------------------------------------------------
+class SimilarityIndex:
+    def __init__(self):
+        # Band key -> positions of quotes with that band
+        self.buckets = {}
+        # Position -> the quote's band keys, so it can be removed again
+        self.quote_keys = {}
+
+    def __len__(self) -> int:
+        return len(self.quote_keys)
+
+    def add(self, position: int, text: str):
+        keys = band_keys(shingles(text))
+        self.quote_keys[position] = keys
+        for key in keys:
+            try:
+                self.buckets[key].append(position)
+            except KeyError:
+                self.buckets[key] = [position]
+
+    def remove(self, position: int):
+        for key in self.quote_keys.pop(position, ()):
+            bucket = self.buckets[key]
+            bucket.remove(position)
+            if not bucket:
+                del self.buckets[key]
+
+    def find_similar(self, text: str, get_text) -> tuple:
+        """Returns (position, similarity) of the most similar quote, or
+        (-1, 0.0) if no quote is at least SIMILARITY_THRESHOLD similar.
+
+        'get_text' returns the text of the quote at a position.
+        """
+        text_shingles = shingles(text)
+        candidates = set()
+        for key in band_keys(text_shingles):
+            candidates.update(self.buckets.get(key, ()))
+
+        best_position = -1
+        best_similarity = 0.0
+        for position in candidates:
+            score = similarity(text_shingles, shingles(get_text(position)))
+            if score > best_similarity or (
+                    score == best_similarity and position < best_position):
+                best_position = position
+                best_similarity = score
+
+        if best_similarity < SIMILARITY_THRESHOLD:
+            return -1, 0.0
+        return best_position, best_similarity
+
+
+# Search index------------------------------------------------------------------
+def words(text: str) -> list:
+    return word_regex.findall(text.lower())
+
+
+class SearchIndex:
+    def __init__(self):
+        # Word -> positions of the quotes containing it
+        self.postings = {}
+        # Position -> the quote's distinct words, and how many words it has
+        self.quote_words = {}
+        self.lengths = {}
+
+    def __len__(self) -> int:
+        return len(self.quote_words)
+
+    def add(self, position: int, text: str):
+        text_words = words(text)
+        distinct = set(text_words)
+        self.quote_words[position] = distinct
+        self.lengths[position] = len(text_words)
+        for word in distinct:
+            try:
+                self.postings[word].add(position)
+            except KeyError:
+                self.postings[word] = {position}
+
+    def remove(self, position: int):
+        for word in self.quote_words.pop(position, ()):
+            posting = self.postings[word]
+            posting.discard(position)
+            if not posting:
+                del self.postings[word]
+        self.lengths.pop(position, None)
+
+    def search(self, text: str, limit: int) -> list:
+        """Returns up to 'limit' positions of quotes containing every word of
+        'text'. Shorter quotes come first as the words make up more of them,
+        then older quotes.
+        """
+        query = set(words(text))
+        if not query:
+            return []
+
+        try:
+            postings = sorted(
+                (self.postings[word] for word in query), key=len
+            )
+        except KeyError:
+            # A word that's in no quote
+            return []
+
+        matches = postings[0]
+        for posting in postings[1:]:
+            matches = matches & posting
+            if not matches:
+                return []
+
+        lengths = self.lengths
+        return heapq.nsmallest(
+            limit, matches, key=lambda position: (lengths[position], position)
+        )
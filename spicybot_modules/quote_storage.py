@@ -0,0 +1,542 @@
+"""
+Description:
+On-disk storage for quotes and streamer nicknames.
+
+There are two storage engines with the same methods. JournalQuoteStorage keeps
+flat files and is used by default. SQLiteQuoteStorage keeps everything in one
+indexed database, and is used once that database has been created by importing
+the flat files:
+
+    python spicybot_modules/quote_storage.py import <storage directory>
+
+The same script checks the flat files for malformed lines, and with --repair
+moves them out into "<file>.rejected":
+
+    python spicybot_modules/quote_storage.py validate [--repair] <storage directory>
+
+With JournalQuoteStorage, each channel has a snapshot file with one quote per
+line, in the format "text|person|date". New quotes are appended to the
+snapshot. Edits and deletions are appended to the channel's journal as
+"position|text|person|date" records instead of rewriting the snapshot, and are
+replayed over the snapshot when it is loaded. Once a journal grows large enough it is compacted: the full
+list of quotes is written to a temporary file that then atomically replaces the
+snapshot, after which the journal is emptied. Replaying a record sets a quote
+to a value, so replaying a journal that was already compacted is harmless.
+"""
+
+# Imports-----------------------------------------------------------------------
+import os
+import sys
+import warnings
+import threading
+
+if __package__:
+    from . import storage
+else:
+    # Run as a script, see the description above
+    import storage
+
+# Global Variables--------------------------------------------------------------
+SAVE_FORMAT = "{}|{}|{}\n"
+JOURNAL_FORMAT = "{}|" + SAVE_FORMAT
+
+DATABASE_NAME = "quotes.sqlite"
+NICKNAMES_NAME = "nicknames.txt"
+
+# A journal is compacted once it has this many records, or more records than a
+# quarter of the channel's quotes, whichever is larger.
+COMPACT_MIN_RECORDS = 64
+
+
+# Parsing-----------------------------------------------------------------------
+class MalformedLine:
+    """A line that could not be parsed, 'offset' is its position in bytes."""
+    __slots__ = ("path", "line_number", "offset", "line", "reason")
+
+    def __init__(self, path: str, line_number: int, offset: int, line: bytes,
+                 reason: str):
+        self.path = path
+        self.line_number = line_number
+        self.offset = offset
+        self.line = line
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return "{}:{} (byte {}): {}".format(
+            self.path, self.line_number, self.offset, self.reason
+        )
+
+
+def _warn_malformed(malformed: MalformedLine):
+    warnings.warn("Malformed quotes line at {}".format(malformed))
+
+
+def parse_quote(line: str) -> tuple:
+    """Parses a "text|person|date" line, raises ValueError if malformed."""
+    information = line.rstrip('\n').rsplit('|', 2)
+    if len(information) < 3:
+        raise ValueError("Expected 3 fields, found {}".format(len(information)))
+
+    return (information[0], information[1].strip(), information[2].strip())
+
+
+def parse_journal_record(line: str) -> tuple:
+    """Parses a "position|text|person|date" line, raises ValueError if
+    malformed.
+    """
+    position, quote = line.split('|', 1)
+    return int(position), parse_quote(quote)
+
+
+def _iter_lines(path: str, parse, on_error):
+    # Read in binary so the byte offset of each line is known, and decode one
+    # line at a time so that only a single line is ever held in memory.
+    offset = 0
+    with open(path, 'rb') as lines:
+        for line_number, line in enumerate(lines, 1):
+            try:
+                yield line_number, offset, parse(line.decode('utf-8'))
+            except (ValueError, UnicodeDecodeError) as error:
+                on_error(MalformedLine(path, line_number, offset, line, str(error)))
+            offset += len(line)
+
+
+def iter_quote_file(path: str, on_error=_warn_malformed):
+    """Yields (line number, offset, quote) for each line of a quotes file, as
+    it is read.
+
+    Malformed lines are skipped and passed to 'on_error' as a MalformedLine.
+    """
+    return _iter_lines(path, parse_quote, on_error)
+
+
+def iter_journal_file(path: str, on_error=_warn_malformed):
+    """Yields (line number, offset, (position, quote)) for each record of a
+    journal.
+    """
+    return _iter_lines(path, parse_journal_record, on_error)
+
+
+def normalize(text: str) -> str:
+    """Returns the form of a quote's text that is used to find duplicates."""
+    return text.strip().lower()
+
+
+def _quote_row(quote) -> tuple:
+    """Returns (text, person, date, normalized text) for a quote, in the form
+    they are saved in.
+    """
+    text, person, date = quote
+    return text, person, str(date), normalize(text)
+
+
+# Storage-----------------------------------------------------------------------
+class JournalQuoteStorage:
+    def __init__(self, directory: str, journal_directory: str,
+                 nicknames_path: str, on_error=_warn_malformed):
+        self.directory = directory
+        self.journal_directory = journal_directory
+        self.nicknames_path = nicknames_path
+        self.on_error = on_error
+        for path in (directory, journal_directory):
+            if not os.path.exists(path):
+                os.mkdir(path)
+
+        # Channel -> number of records in its journal
+        self.journal_sizes = {}
+
+        # A channel's files are only read or written with its lock held, as
+        # a channel evicted from the cache is compacted on whichever thread
+        # evicted it, maybe while another thread is changing its quotes.
+        self.channel_locks = {}
+        self.channel_locks_lock = threading.Lock()
+
+        # Held while rewriting the nicknames file, as commands from different
+        # channels may be handled at the same time.
+        self.nicknames_lock = threading.Lock()
+
+    def channel_lock(self, channel: str) -> threading.RLock:
+        with self.channel_locks_lock:
+            try:
+                return self.channel_locks[channel]
+            except KeyError:
+                lock = threading.RLock()
+                self.channel_locks[channel] = lock
+                return lock
+
+    def snapshot_path(self, channel: str) -> str:
+        return os.path.join(self.directory, channel)
+
+    def journal_path(self, channel: str) -> str:
+        return os.path.join(self.journal_directory, channel)
+
+    def channels(self) -> list:
+        """Returns every channel that has a quotes file. Channel names can't
+        contain '.', so temporary files and the '.rejected' and '.repairing'
+        files written by 'validate --repair' are left out.
+        """
+        return [
+            name for name in os.listdir(self.directory) if '.' not in name
+        ]
+
+    def create(self, channel: str):
+        """Creates an empty quotes file for a channel if it has none."""
+        if not os.path.exists(self.snapshot_path(channel)):
+            open(self.snapshot_path(channel), 'w').close()
+
+    def load(self, channel: str) -> list:
+        """Returns a channel's quotes, with its journal applied."""
+        with self.channel_lock(channel):
+            return self._load(channel)
+
+    def _load(self, channel: str) -> list:
+        quotes = []
+        snapshot = self.snapshot_path(channel)
+        if os.path.exists(snapshot):
+            for line_number, offset, quote in iter_quote_file(
+                    snapshot, self.on_error):
+                quotes.append(quote)
+
+        records = 0
+        journal = self.journal_path(channel)
+        if os.path.exists(journal):
+            # Bad records are most likely ones cut short by a crash
+            for line_number, offset, (position, quote) in iter_journal_file(
+                    journal, self.on_error):
+                if position >= len(quotes):
+                    self.on_error(MalformedLine(
+                        journal, line_number, offset, b'',
+                        "Quote #{} does not exist".format(position + 1)
+                    ))
+                    continue
+                quotes[position] = quote
+                records += 1
+
+        self.journal_sizes[channel] = records
+        return quotes
+
+    def append(self, channel: str, quote: tuple):
+        """Saves a new quote at the end of a channel's quotes."""
+        with self.channel_lock(channel):
+            with open(self.snapshot_path(channel), 'a') as quotes_file:
+                quotes_file.write(SAVE_FORMAT.format(*quote))
+
+    def update(self, channel: str, changes: list, quotes: list):
+        """Records (position, quote) changes in a channel's journal.
+
+        'quotes' is the channel's full, already updated, list of quotes. It is
+        only used if the journal has grown large enough to be compacted.
+        """
+        with self.channel_lock(channel):
+            with open(self.journal_path(channel), 'a') as journal_file:
+                for position, quote in changes:
+                    journal_file.write(JOURNAL_FORMAT.format(position, *quote))
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+            records = self.journal_sizes.get(channel, 0) + len(changes)
+            self.journal_sizes[channel] = records
+            if records >= max(COMPACT_MIN_RECORDS, len(quotes) // 4):
+                self.compact(channel, quotes)
+
+    def compact(self, channel: str, quotes: list):
+        """Writes every quote into a new snapshot and empties the journal."""
+        with self.channel_lock(channel):
+            self._compact(channel, quotes)
+
+    def _compact(self, channel: str, quotes: list):
+        snapshot = self.snapshot_path(channel)
+        temporary = os.path.join(self.directory, '.{}.tmp'.format(channel))
+        with open(temporary, 'w') as quotes_file:
+            for quote in quotes:
+                quotes_file.write(SAVE_FORMAT.format(*quote))
+            quotes_file.flush()
+            os.fsync(quotes_file.fileno())
+        os.replace(temporary, snapshot)
+
+        if os.path.exists(self.journal_path(channel)):
+            os.remove(self.journal_path(channel))
+        self.journal_sizes[channel] = 0
+
+    def has_journal(self, channel: str) -> bool:
+        return self.journal_sizes.get(channel, 0) > 0
+
+    def load_nicknames(self) -> dict:
+        nicknames = {}
+        if not os.path.exists(self.nicknames_path):
+            return nicknames
+
+        with open(self.nicknames_path, 'r') as nicknames_file:
+            for index, line in enumerate(nicknames_file):
+                information = line.rsplit('=', 1)
+
+                if len(information) < 2:
+                    warnings.warn(
+                        "Issue loading nickname for line #{} in file '{}'!".format(
+                            index, self.nicknames_path
+                        )
+                    )
+                    continue
+
+                nicknames[information[0].strip()] = information[1].strip()
+
+        return nicknames
+
+    def save_nickname(self, channel: str, nickname: str, nicknames: dict):
+        """Saves a channel's nickname. 'nicknames' holds every channel's
+        nickname, with the new one already set.
+        """
+        with self.nicknames_lock, storage.locked_file(self.nicknames_path):
+            # Other bot processes may have changed other channels' nicknames
+            saved = self.load_nicknames()
+            saved[channel] = nickname
+            storage.replace_file(self.nicknames_path, ''.join(
+                '{}={}\n'.format(channel, saved[channel]) for channel in saved
+            ))
+
+    def close(self):
+        pass
+
+
+class SQLiteQuoteStorage:
+    """Keeps quotes in a database, indexed by channel and quote number, and by
+    channel and normalized text.
+
+    Quote numbers start at 1, so quote_id is a quote's position plus one.
+    Connections come from the shared pool in storage.py, so channels can be
+    read and written from several threads at once.
+    """
+
+    def __init__(self, path: str):
+        self.pool = storage.open_pool(path)
+        with self.pool.connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS quotes ("
+                "channel TEXT NOT NULL, quote_id INTEGER NOT NULL, "
+                "text TEXT NOT NULL, person TEXT NOT NULL, date TEXT NOT NULL, "
+                "normalized TEXT NOT NULL, "
+                "PRIMARY KEY (channel, quote_id)) WITHOUT ROWID"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS quotes_normalized "
+                "ON quotes (channel, normalized)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS nicknames ("
+                "channel TEXT PRIMARY KEY, nickname TEXT NOT NULL)"
+            )
+
+    def channels(self) -> list:
+        return [
+            row[0] for row in self.pool.execute(
+                "SELECT DISTINCT channel FROM quotes"
+            )
+        ]
+
+    def create(self, channel: str):
+        # Channels exist as soon as they have a quote
+        pass
+
+    def load(self, channel: str) -> list:
+        return [
+            [text, person, date] for text, person, date in
+            self.pool.execute(
+                "SELECT text, person, date FROM quotes "
+                "WHERE channel=? ORDER BY quote_id",
+                (channel,)
+            )
+        ]
+
+    def append(self, channel: str, quote: tuple):
+        with self.pool.connection() as connection:
+            connection.execute(
+                "INSERT INTO quotes "
+                "(channel, quote_id, text, person, date, normalized) "
+                "SELECT ?, COALESCE(MAX(quote_id), 0) + 1, ?, ?, ?, ? "
+                "FROM quotes WHERE channel=?",
+                (channel,) + _quote_row(quote) + (channel,)
+            )
+
+    def update(self, channel: str, changes: list, quotes: list):
+        with self.pool.connection() as connection:
+            connection.executemany(
+                "UPDATE quotes SET text=?, person=?, date=?, normalized=? "
+                "WHERE channel=? AND quote_id=?",
+                [
+                    _quote_row(quote) + (channel, position + 1)
+                    for position, quote in changes
+                ]
+            )
+
+    def compact(self, channel: str, quotes: list):
+        # Every change is already written in place
+        pass
+
+    def has_journal(self, channel: str) -> bool:
+        return False
+
+    def load_nicknames(self) -> dict:
+        return dict(self.pool.execute(
+            "SELECT channel, nickname FROM nicknames"
+        ))
+
+    def save_nickname(self, channel: str, nickname: str, nicknames: dict):
+        with self.pool.connection() as connection:
+            connection.execute(
+                "INSERT INTO nicknames (channel, nickname) VALUES (?, ?) "
+                "ON CONFLICT (channel) DO UPDATE SET nickname=excluded.nickname",
+                (channel, nickname)
+            )
+
+    def close(self):
+        self.pool.close()
+
+
+# Storage selection-------------------------------------------------------------
+def open_storage(storage_directory: str, on_error=_warn_malformed):
+    """Returns the SQLite storage if its database has been created, otherwise
+    the flat file storage.
+    """
+    database_path = os.path.join(storage_directory, DATABASE_NAME)
+    if os.path.exists(database_path):
+        return SQLiteQuoteStorage(database_path)
+
+    return JournalQuoteStorage(
+        os.path.join(storage_directory, 'quotes'),
+        os.path.join(storage_directory, 'quotes_journal'),
+        os.path.join(storage_directory, NICKNAMES_NAME),
+        on_error
+    )
+
+
+def import_flat_files(storage_directory: str) -> int:
+    """Copies every channel's quotes file, journal included, and the nicknames
+    file into a new SQLite database. Returns the number of quotes imported.
+
+    The flat files are left untouched. From then on open_storage() will use the
+    database.
+    """
+    database_path = os.path.join(storage_directory, DATABASE_NAME)
+    if os.path.exists(database_path):
+        raise FileExistsError(
+            "Quotes database already exists: {}".format(database_path)
+        )
+
+    files = JournalQuoteStorage(
+        os.path.join(storage_directory, 'quotes'),
+        os.path.join(storage_directory, 'quotes_journal'),
+        os.path.join(storage_directory, NICKNAMES_NAME)
+    )
+
+    # Build the database under a temporary name, so that a failed import
+    # doesn't leave a half filled database behind to be picked up.
+    temporary_path = database_path + '.importing'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    database = SQLiteQuoteStorage(temporary_path)
+    imported = 0
+    with database.pool.connection() as connection:
+        for channel in files.channels():
+            rows = [
+                (channel, position + 1) + _quote_row(quote)
+                for position, quote in enumerate(files.load(channel))
+            ]
+            connection.executemany(
+                "INSERT INTO quotes "
+                "(channel, quote_id, text, person, date, normalized) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            imported += len(rows)
+
+        connection.executemany(
+            "INSERT INTO nicknames (channel, nickname) VALUES (?, ?)",
+            files.load_nicknames().items()
+        )
+    database.close()
+
+    os.replace(temporary_path, database_path)
+    return imported
+
+
+# Validation--------------------------------------------------------------------
+def validate_file(path: str, journal: bool=False, repair: bool=False,
+                  on_error=print) -> int:
+    """Checks every line of a quotes file or journal, passing each malformed
+    line to 'on_error'. Returns the number of malformed lines.
+
+    With 'repair', a file with malformed lines is rewritten without them. The
+    removed lines are appended to "<path>.rejected" so nothing is lost.
+    """
+    parse = iter_journal_file if journal else iter_quote_file
+    malformed = 0
+    rejected = None
+    repaired = open(path + '.repairing', 'w') if repair else None
+
+    def report(error: MalformedLine):
+        nonlocal malformed, rejected
+        malformed += 1
+        on_error(error)
+        if repair:
+            if rejected is None:
+                rejected = open(path + '.rejected', 'ab')
+            rejected.write(error.line)
+
+    try:
+        for line_number, offset, record in parse(path, report):
+            if not repair:
+                continue
+            if journal:
+                repaired.write(JOURNAL_FORMAT.format(record[0], *record[1]))
+            else:
+                repaired.write(SAVE_FORMAT.format(*record))
+    finally:
+        if rejected is not None:
+            rejected.close()
+        if repaired is not None:
+            repaired.flush()
+            os.fsync(repaired.fileno())
+            repaired.close()
+
+    if repair:
+        if malformed:
+            os.replace(path + '.repairing', path)
+        else:
+            os.remove(path + '.repairing')
+    return malformed
+
+
+if __name__ == "__main__":
+    usage = (
+        "Usage: {0} import <storage directory>\n"
+        "       {0} validate [--repair] <storage directory>".format(sys.argv[0])
+    )
+    arguments = sys.argv[1:]
+    repair = "--repair" in arguments
+    if repair:
+        arguments.remove("--repair")
+
+    if len(arguments) != 2 or arguments[0] not in ("import", "validate"):
+        print(usage)
+        sys.exit(1)
+
+    command, storage_directory = arguments
+    if command == "import":
+        print("Imported {} quotes.".format(import_flat_files(storage_directory)))
+        sys.exit()
+
+    malformed = 0
+    for directory, journal in (('quotes', False), ('quotes_journal', True)):
+        directory = os.path.join(storage_directory, directory)
+        if not os.path.exists(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('.') or '.' in name:
+                continue
+            malformed += validate_file(
+                os.path.join(directory, name), journal, repair
+            )
+
+    print("Found {} malformed lines.".format(malformed))
+    sys.exit(1 if malformed and not repair else 0)
@@ -0,0 +1,447 @@
+"""
+Description:
+In-memory storage of each channel's quotes.
+
+Quotes are kept in the order they were made, so that a quote's number is its
+position plus one. Alongside the list the store keeps an index of normalized
+quote text, so duplicates are found with a single lookup, and a bitmap of which
+quotes are deleted, so counting them doesn't require going through every quote.
+
+Channels are only loaded when they're first used, and are dropped again when
+idle or when too many quotes are loaded, see ChannelCache.
+"""
+
+# Imports-----------------------------------------------------------------------
+import sys
+import time
+import datetime
+import threading
+from random import randrange
+from collections import OrderedDict
+from .quote_index import SimilarityIndex, SearchIndex
+from .quote_storage import normalize
+
+# Global Variables--------------------------------------------------------------
+DELETED_FILL = "###DELETED###"
+QUOTE_FORMAT = "\"{}\" - {} ({})"
+
+# The similarity index is built on its own thread, this many quotes at a time,
+# so a change to the channel's quotes waits for at most one chunk.
+SIMILARITY_CHUNK = 200
+
+
+def to_ordinal(date):
+    """Turns a date, or a "YYYY-MM-DD" string, into its ordinal. Strings in any
+    other format are returned as they are.
+    """
+    if isinstance(date, int):
+        return date
+    if isinstance(date, datetime.date):
+        return date.toordinal()
+    try:
+        return datetime.date.fromisoformat(date).toordinal()
+    except ValueError:
+        return date
+
+
+# Quote-------------------------------------------------------------------------
+class Quote:
+    """A single quote.
+
+    The date is stored as an ordinal (see datetime.date.toordinal) and the
+    quoted person's name is interned, as most quotes in a channel share it. A
+    deleted quote has no text or person, only the date it was deleted on.
+    """
+    __slots__ = ("text", "person", "date")
+
+    def __init__(self, text: str, person: str, date):
+        if text == DELETED_FILL and person == DELETED_FILL:
+            self.text = None
+            self.person = None
+        else:
+            self.text = text
+            self.person = sys.intern(person)
+        self.date = to_ordinal(date)
+
+    @classmethod
+    def deleted(cls, date) -> "Quote":
+        return cls(DELETED_FILL, DELETED_FILL, date)
+
+    @property
+    def is_deleted(self) -> bool:
+        return self.text is None
+
+    @property
+    def date_string(self) -> str:
+        if isinstance(self.date, int):
+            return datetime.date.fromordinal(self.date).isoformat()
+        return self.date
+
+    def render(self) -> str:
+        return QUOTE_FORMAT.format(self.text, self.person, self.date_string)
+
+    def __iter__(self):
+        """Yields the quote's fields in the form they are saved in."""
+        if self.text is None:
+            yield DELETED_FILL
+            yield DELETED_FILL
+        else:
+            yield self.text
+            yield self.person
+        yield self.date_string
+
+    def __repr__(self) -> str:
+        return "Quote({!r}, {!r}, {!r})".format(*self)
+
+
+# Shuffle bag-------------------------------------------------------------------
+class ShuffleBag:
+    """Draws items in a random order, without repeating any until every item
+    has been drawn, after which the bag is refilled.
+
+    items[:remaining] are the items not yet drawn this round. Drawing swaps the
+    chosen item to the end of that range, so every operation takes constant
+    time.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+        self.remaining = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _swap(self, first: int, second: int):
+        items = self.items
+        items[first], items[second] = items[second], items[first]
+        self.positions[items[first]] = first
+        self.positions[items[second]] = second
+
+    def add(self, item):
+        """Adds an item that can be drawn during the current round."""
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+        self._swap(len(self.items) - 1, self.remaining)
+        self.remaining += 1
+
+    def remove(self, item):
+        position = self.positions[item]
+        if position < self.remaining:
+            # Move it out of the undrawn range first
+            self.remaining -= 1
+            self._swap(position, self.remaining)
+            position = self.remaining
+
+        self._swap(position, len(self.items) - 1)
+        self.items.pop()
+        del self.positions[item]
+
+    def draw(self):
+        """Returns a random item, raises IndexError if the bag is empty."""
+        if not self.items:
+            raise IndexError("Cannot draw from an empty bag")
+
+        if self.remaining == 0:
+            self.remaining = len(self.items)
+
+        self.remaining -= 1
+        self._swap(randrange(self.remaining + 1), self.remaining)
+        return self.items[self.remaining]
+
+
+# Quote store-------------------------------------------------------------------
+class QuoteStore:
+    def __init__(self, quotes: list=()):
+        """'quotes' may hold Quote objects or (text, person, date) fields."""
+        self.quotes = []
+        self.deleted = bytearray()
+        self.deleted_count = 0
+
+        # Normalized text -> positions, only for quotes that are not deleted.
+        # There's more than one position if the text was duplicated on disk.
+        self.text_index = {}
+
+        # Positions of quotes that are not deleted, for random quotes
+        self.sampler = ShuffleBag()
+
+        # Only built once they are first used, see find_similar() and search()
+        self.similarity = None
+        self.search_index = None
+
+        # While the similarity index is being built, 'building' holds it with
+        # the quotes before 'built_to' added. 'lock' is held while quotes
+        # change and while each chunk is added.
+        self.building = None
+        self.built_to = 0
+        self.lock = threading.Lock()
+
+        for quote in quotes:
+            if not isinstance(quote, Quote):
+                quote = Quote(*quote)
+            self.append(quote)
+
+    def __len__(self) -> int:
+        return len(self.quotes)
+
+    def __getitem__(self, position: int) -> Quote:
+        return self.quotes[position]
+
+    def __iter__(self):
+        return iter(self.quotes)
+
+    @property
+    def live_count(self) -> int:
+        return len(self.quotes) - self.deleted_count
+
+    def is_deleted(self, position: int) -> bool:
+        return bool(self.deleted[position])
+
+    def random_position(self) -> int:
+        """Returns the position of a random quote that is not deleted, or -1
+        if there are none. Quotes aren't repeated until all have been drawn.
+        """
+        try:
+            return self.sampler.draw()
+        except IndexError:
+            return -1
+
+    def find(self, text: str) -> int:
+        """Returns the position of the oldest live quote with the same text,
+        or -1.
+        """
+        positions = self.text_index.get(normalize(text))
+        return min(positions) if positions else -1
+
+    def find_similar(self, text: str) -> tuple:
+        """Returns (position, similarity) of the live quote most similar to
+        'text', or (-1, 0.0) if none are similar enough.
+
+        The first call starts building the index on another thread, and
+        until it's done no quote is found similar.
+        """
+        with self.lock:
+            if self.similarity is None:
+                if self.building is None:
+                    self.building = SimilarityIndex()
+                    self.built_to = 0
+                    threading.Thread(
+                        target=self._build_similarity, name="similarity",
+                        daemon=True
+                    ).start()
+                return -1, 0.0
+
+            return self.similarity.find_similar(
+                text, lambda position: self.quotes[position].text
+            )
+
+    def _build_similarity(self):
+        while True:
+            with self.lock:
+                end = min(self.built_to + SIMILARITY_CHUNK, len(self.quotes))
+                for position in range(self.built_to, end):
+                    quote = self.quotes[position]
+                    if not quote.is_deleted:
+                        self.building.add(position, quote.text)
+                self.built_to = end
+
+                if end == len(self.quotes):
+                    self.similarity = self.building
+                    self.building = None
+                    return
+
+    def search(self, text: str, limit: int=5) -> list:
+        """Returns the positions of up to 'limit' live quotes containing every
+        word in 'text', best matches first.
+        """
+        if self.search_index is None:
+            self.search_index = SearchIndex()
+            for position, quote in enumerate(self.quotes):
+                if not quote.is_deleted:
+                    self.search_index.add(position, quote.text)
+
+        return self.search_index.search(text, limit)
+
+    def _index(self, position: int, quote: Quote):
+        if quote.is_deleted:
+            self.deleted[position] = 1
+            self.deleted_count += 1
+        else:
+            key = normalize(quote.text)
+            try:
+                self.text_index[key].add(position)
+            except KeyError:
+                self.text_index[key] = {position}
+            self.sampler.add(position)
+            if self.similarity is not None:
+                self.similarity.add(position, quote.text)
+            elif self.building is not None and position < self.built_to:
+                self.building.add(position, quote.text)
+            if self.search_index is not None:
+                self.search_index.add(position, quote.text)
+
+    def _unindex(self, position: int, quote: Quote):
+        if self.deleted[position]:
+            self.deleted[position] = 0
+            self.deleted_count -= 1
+        else:
+            key = normalize(quote.text)
+            positions = self.text_index[key]
+            positions.discard(position)
+            if not positions:
+                del self.text_index[key]
+            self.sampler.remove(position)
+            if self.similarity is not None:
+                self.similarity.remove(position)
+            elif self.building is not None and position < self.built_to:
+                self.building.remove(position)
+            if self.search_index is not None:
+                self.search_index.remove(position)
+
+    def append(self, quote: Quote) -> int:
+        """Adds a quote to the end of the store and returns its position."""
+        with self.lock:
+            position = len(self.quotes)
+            self.quotes.append(quote)
+            self.deleted.append(0)
+            self._index(position, quote)
+        return position
+
+    def replace(self, position: int, quote: Quote):
+        """Overwrites the quote at a position, deleted quotes included."""
+        with self.lock:
+            self._unindex(position, self.quotes[position])
+            self.quotes[position] = quote
+            self._index(position, quote)
+
+
+# Loaded channels---------------------------------------------------------------
+class ChannelCache:
+    """Loads a channel's quotes the first time they are used.
+
+    Channels are kept from least to most recently used. Once more than
+    'max_quotes' quotes are loaded, the least recently used channels are
+    evicted until the total is back under the cap, and channels that haven't
+    been used for 'idle_seconds' are evicted as other channels are used.
+    'on_evict' is called with a channel's name and store after it's dropped.
+
+    Loading and evicting only hold the channel's own lock while they wait on
+    the disk, so other channels aren't held up. A channel whose lock is held,
+    see channel_lock(), is never evicted.
+    """
+
+    def __init__(self, load, max_quotes: int, idle_seconds: float,
+                 on_evict=None):
+        self.load = load
+        self.max_quotes = max_quotes
+        self.idle_seconds = idle_seconds
+        self.on_evict = on_evict
+
+        # Channel -> [store, time last used]
+        self.channels = OrderedDict()
+        self.lock = threading.RLock()
+
+        # Channel -> lock held while it's loaded, changed or evicted
+        self.channel_locks = {}
+
+    def channel_lock(self, channel: str) -> threading.RLock:
+        """Returns a channel's lock. While it's held the channel stays loaded,
+        so a store fetched with it held is the one its changes are saved from.
+        """
+        with self.lock:
+            try:
+                return self.channel_locks[channel]
+            except KeyError:
+                lock = threading.RLock()
+                self.channel_locks[channel] = lock
+                return lock
+
+    def __getitem__(self, channel: str) -> QuoteStore:
+        with self.lock:
+            entry = self._use(channel)
+
+        if entry is None:
+            with self.channel_lock(channel):
+                # Another thread may have loaded it while this one waited
+                with self.lock:
+                    entry = self._use(channel)
+                if entry is None:
+                    store = QuoteStore(self.load(channel))
+                    with self.lock:
+                        entry = [store, time.monotonic()]
+                        self.channels[channel] = entry
+
+        self._evict(self._remove_evicted(channel))
+        return entry[0]
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self.channels
+
+    def __iter__(self):
+        """Iterates over the channels that are currently loaded."""
+        with self.lock:
+            return iter(list(self.channels))
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def set_limits(self, max_quotes: int, idle_seconds: float):
+        with self.lock:
+            self.max_quotes = max_quotes
+            self.idle_seconds = idle_seconds
+        self._evict(self._remove_evicted())
+
+    def loaded_quotes(self) -> int:
+        return sum(len(entry[0]) for entry in self.channels.values())
+
+    def _use(self, channel: str) -> list:
+        """Marks a loaded channel as just used and returns its entry, or None
+        if it isn't loaded. Call with 'lock' held.
+        """
+        entry = self.channels.get(channel)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self.channels.move_to_end(channel)
+        return entry
+
+    def _remove_evicted(self, keep: str=None) -> list:
+        """Removes the channels to evict, other than 'keep', and returns them
+        as (channel, store, lock) with each channel's lock held.
+        """
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            total = self.loaded_quotes()
+            # The most recently used channel is never evicted
+            for channel in list(self.channels)[:-1]:
+                store, last_used = self.channels[channel]
+                if (total <= self.max_quotes
+                        and now - last_used < self.idle_seconds):
+                    break
+                if channel == keep:
+                    # The caller may be holding its lock
+                    continue
+
+                lock = self.channel_lock(channel)
+                if not lock.acquire(blocking=False):
+                    # In use, it'll be evicted once it's free
+                    continue
+                del self.channels[channel]
+                total -= len(store)
+                evicted.append((channel, store, lock))
+        return evicted
+
+    def _evict(self, evicted: list):
+        for channel, store, lock in evicted:
+            try:
+                if self.on_evict:
+                    self.on_evict(channel, store)
+            finally:
+                lock.release()
+
+    def evict(self, channel: str):
+        with self.channel_lock(channel):
+            with self.lock:
+                entry = self.channels.pop(channel, None)
+            if entry and self.on_evict:
+                self.on_evict(channel, entry[0])
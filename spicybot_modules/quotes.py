@@ -20,27 +20,23 @@ quotes during livestreams.
 #       both ways. If used on a reverted quote
 #       it'll return to the latest edit.
 # TODO: Make broadcaster_nickname changes apply to the quotes file
-# TODO: When fixing up the entire set of code, consider implementing a system
-#       to stop quotes for being repeated for some time.
 # TODO: Fix bug where commands like '!quote add --name=amama... Test' result
 #       in a quote that looks like this:
 #           "--name=amama... Test" - amama... Test (DATE)
 
 # Imported Modules--------------------------------------------------------------
-import re
 import os
 import datetime
-import warnings
-from random import randint
-from difflib import SequenceMatcher
 import spicytwitch
+from . import outbound, router
+from .quote_store import ChannelCache, Quote
+from . import quote_storage
+from .storage import locked_file, replace_file
 
 # Global Variables--------------------------------------------------------------
 IRC = spicytwitch.irc
 module_tools = spicytwitch.bot.modules
 
-DELETED_FILL = "###DELETED###"
-
 # Offset to account for spaces and any other extra characters when formatting
 # the quote, so that it doesn't exceed twitch's character limit.
 SIZE_OFFSET = 20
@@ -48,15 +44,22 @@ SIZE_OFFSET = 20
 # Max size of a message
 MAX_SIZE = 500
 
-SAVE_FORMAT = "{}|{}|{}\n"
-QUOTE_FORMAT = "\"{}\" - {} ({})"
 INDEX_FORMAT = " [#{}]"
 
+# Number of quote numbers listed after the best search result
+SEARCH_RESULTS = 5
+
 RESERVED_COMMAND_NAMES = [
     "quote"
 ]
 
-quotes = {}
+# Channels' quotes are loaded on first use. Once more than this many quotes are
+# loaded the least recently used channels are dropped from memory, as are
+# channels nobody has used a quote command in for IDLE_CHANNEL_SECONDS. Both
+# can be changed with set_cache_limits(), see "max_loaded_quotes" in main.py.
+MAX_LOADED_QUOTES = 100000
+IDLE_CHANNEL_SECONDS = 60 * 60
+
 nicknames = {}
 
 
@@ -66,6 +69,8 @@ quote_edit_regex = r"quote edit (\d+)( --\w+=\w+)? (.+)"
 quote_add_regex = r"quote add( --\w+=\w+)? (.+)"
 quote_delete_regex = r"quote delete (\d+)"
 quote_set_nickname_regex = r"quote set nickname (.+)"
+quote_similarity_regex = r"quote similarity (on|off)"
+quote_search_regex = r"quote search (.+)"
 
 # Module Registration-----------------------------------------------------------
 module_tools.register_command_module()
@@ -89,53 +94,40 @@ class DoesNotExist(Exception):
 
 # Quotes management-------------------------------------------------------------
 # Setting up storage
-quotes_directory = os.path.join(storage_directory, 'quotes')
-if not os.path.exists(quotes_directory):
-    logger.debug("Created directory for quotes files")
-    os.mkdir(quotes_directory)
+def _report_malformed(malformed: quote_storage.MalformedLine):
+    logger.warning("Skipping malformed quotes line at {}".format(malformed))
+
+
+storage = quote_storage.open_storage(storage_directory, _report_malformed)
+
+
+def _unload_channel(channel: str, channel_quotes: list):
+    logger.info("Unloading quotes for: {}".format(channel))
+    if storage.has_journal(channel):
+        storage.compact(channel, channel_quotes)
+
+
+def _load_channel(channel: str) -> list:
+    logger.info("Loading quotes for: {}".format(channel))
+    return storage.load(channel)
+
+
+quotes = ChannelCache(
+    _load_channel, MAX_LOADED_QUOTES, IDLE_CHANNEL_SECONDS, _unload_channel
+)
+
+def set_cache_limits(max_quotes: int=MAX_LOADED_QUOTES,
+                     idle_seconds: float=IDLE_CHANNEL_SECONDS):
+    quotes.set_limits(max_quotes, idle_seconds)
+
 
 # Setting up quotes files for joined channels
 def initialize_channels():
-    global quotes
     for channel in IRC.channels:
-        if channel not in os.listdir(quotes_directory):
-            with open(os.path.join(quotes_directory, channel), 'w') as quotes_file:
-                # Create empty file
-                logger.debug("Created empty quotes file for channel: {}".format(channel))
-                quotes_file.close()
-                quotes[channel] = []
+        storage.create(channel)
 initialize_channels()
-                
-
-# Loading quotes
-for channel in os.listdir(quotes_directory):
-
-    channel_name = os.path.basename(channel)
-    logger.info("Loading quotes for: {}".format(channel_name))
-
-    if channel_name not in quotes:
-        logger.debug("Creating empty list to store quotes in")
-        quotes[channel_name] = []
-
-    logger.debug("Opening quotes file")
-    with open(os.path.join(quotes_directory, channel), 'r') as quotes_file:
-        for line in quotes_file.readlines():
-            try:
-                information = line.rsplit('|', 2)
-                quote_text = information[0]
-                quoted_person = information[-2].strip()
-                quote_date = information[-1].strip()
-
-                quotes[channel_name].append([
-                    quote_text, quoted_person, quote_date
-                ])
-            except IndexError:
-                warnings.warn(
-                    "Issue parsing quotes file: {}".format(
-                        os.path.join(quotes_directory, channel)
-                    )
-                )
-                pass
+
+
 def manage_spacing(quote: str, user: IRC.User) -> str:
     new_quote = quote
     front_done = False
@@ -160,66 +152,53 @@ def manage_spacing(quote: str, user: IRC.User) -> str:
 
 
 
-def edit_quote(channel: str, index: int, full_quote: list) -> int:
-    global quotes
-    channel_file = os.path.join(quotes_directory, channel)
+def edit_quote(channel: str, index: int, full_quote: Quote) -> int:
+    # The channel's lock keeps it from being evicted, and reloaded, between
+    # changing the store and saving the change.
+    with quotes.channel_lock(channel):
+        channel_quotes = quotes[channel]
 
-    # Make sure index is not larger than the number of quotes
-    if index > len(quotes[channel]):
-        raise IndexTooLarge("Index larger than number of quotes")
+        # Make sure index is not larger than the number of quotes
+        if index > len(channel_quotes):
+            raise IndexTooLarge("Index larger than number of quotes")
 
-    # Make sure index is positive, account for Zero-based indexing since our
-    # input will come from users.
-    if index > 0:
-        index -= 1
-    elif index < 0:
-        raise negativeindex("quote index must not be negative")
-
-    # create copy of current state of file
-    logger.debug("Creating copy of quotes file in memory")
-    file_copy = None
-    with open(channel_file, 'r') as quotes_file:
-        file_copy = quotes_file.readlines() 
-
-    # rewrite the file, updating the quote when we reach the input index
-    logger.debug("Updating quotes file for new quote")
-    with open(channel_file, 'w') as quotes_file:
-        for i, line in enumerate(file_copy):
-            if i ==  index:
-                quotes_file.write(SAVE_FORMAT.format(*full_quote))
-            else:
-                # stripping just to ensure that only one newline is output
-                quotes_file.write(line.strip() + '\n')
+        # Make sure index is positive, account for Zero-based indexing since
+        # our input will come from users.
+        if index > 0:
+            index -= 1
+        elif index < 0:
+            raise NegativeIndex("quote index must not be negative")
+
+        # update the channel's quotes list
+        logger.debug("Updating channel '{}' quote list".format(channel))
+        channel_quotes.replace(index, full_quote)
 
-    # update the channel's quotes list
-    logger.debug("Updating channel '{}' quote list".format(channel))
-    quotes[channel][index] = full_quote
+        # record the change in the channel's journal
+        logger.debug("Journaling edit of quote #{}".format(index + 1))
+        storage.update(channel, [(index, full_quote)], channel_quotes)
 
     
-def add_quote(channel: str, full_quote: list) -> bool:
-    global quotes
-    channel_file = os.path.join(quotes_directory, channel)
-
-    # check for duplicates
-    logger.debug("Checking if new quote is a duplicate")
-    for quote in quotes:
-        if full_quote[0].lower() == quote[0].lower():
+def add_quote(channel: str, full_quote: Quote) -> int:
+    """Returns the new quote's position, or -1 if it was a duplicate."""
+    with quotes.channel_lock(channel):
+        channel_quotes = quotes[channel]
+
+        # check for duplicates
+        logger.debug("Checking if new quote is a duplicate")
+        if channel_quotes.find(full_quote.text) >= 0:
             logger.debug(
                 "Quote was a duplicate in channel '{}': {}".format(
-                    channel, QUOTE_FORMAT.format(*full_quote)
+                    channel, full_quote.render()
                 )
             )
-            return False  # duplicate quote
-
-    # save quote to file
-    logger.debug("Saving to quotes file")
-    with open(channel_file, 'a') as quotes_file:
-        quotes_file.write(SAVE_FORMAT.format(*full_quote))
+            return -1  # duplicate quote
 
-   # add quote to list
-    quotes[channel].append(full_quote)
+        # save quote to file
+        logger.debug("Saving to quotes file")
+        storage.append(channel, full_quote)
 
-    return True
+        # add quote to list
+        return channel_quotes.append(full_quote)
     
     
 def delete_quote(channel: str, index: int, deleter: str) -> bool:
@@ -229,26 +208,28 @@ def delete_quote(channel: str, index: int, deleter: str) -> bool:
     else:
         check_index = index
 
-    if index > len(quotes[channel]):
-        return "Quote #{} does not exist! sfhHM".format(index)
+    with quotes.channel_lock(channel):
+        channel_quotes = quotes[channel]
+        if index > len(channel_quotes):
+            return "Quote #{} does not exist! sfhHM".format(index)
 
-    quote_copy = quotes[channel][check_index]
-    if quote_copy[0] == DELETED_FILL and quote_copy[-2] == DELETED_FILL:
-        return "Quote #{} was already deleted on {}.".format(
-            index, quote_copy[-1]
-        )
-    else:
+        quote_copy = channel_quotes[check_index]
+        if channel_quotes.is_deleted(check_index):
+            return "Quote #{} was already deleted on {}.".format(
+                index, quote_copy.date_string
+            )
         edit_quote(
             channel,
             index,
-            [DELETED_FILL, DELETED_FILL, datetime.datetime.now().date()]
+            Quote.deleted(datetime.datetime.now().date())
         )
-        logger.info(
-            "User {} has deleted quote #{}, which said: {}".format(
-                deleter, index,  QUOTE_FORMAT.format(*quote_copy)
-            )
-        ) 
-        return "Quote #{index} has been deleted. Rip quote #{index} sfhSAD".format(index=index)
+
+    logger.info(
+        "User {} has deleted quote #{}, which said: {}".format(
+            deleter, index,  quote_copy.render()
+        )
+    )
+    return "Quote #{index} has been deleted. Rip quote #{index} sfhSAD".format(index=index)
 
 
 def get_quote(channel: str, index: int) -> str:
@@ -260,15 +241,17 @@ def get_quote(channel: str, index: int) -> str:
     try:
         chosen_quote = quotes[channel][index]
 
-        if chosen_quote[0] == DELETED_FILL and chosen_quote[1] == DELETED_FILL:
+        if quotes[channel].is_deleted(index):
             # NOTE: If someone asks for quote 1, it'll be turned into 0 and then
             #       it won't be incremented back... I should find a way to fix
             #       this issue.
             if index > 0:
                 index += 1
-            return "Quote #{} was deleted on {} sfhSAD".format(index, chosen_quote[-1])
+            return "Quote #{} was deleted on {} sfhSAD".format(
+                index, chosen_quote.date_string
+            )
         else:
-            return QUOTE_FORMAT.format(*chosen_quote)
+            return chosen_quote.render()
     except IndexError:
         if index > 0:
             # Increment it for user readability
@@ -278,80 +261,69 @@ def get_quote(channel: str, index: int) -> str:
 
 
 def get_random_quote(channel: str) -> str:
-    quote_count = len(quotes[channel])
+    channel_quotes = quotes[channel]
 
-    if quote_count == 0:
+    if len(channel_quotes) == 0:
         return "There are no quotes! sfhSAD"
 
-    random_index = randint(0, quote_count-1)
-    chosen_quote = quotes[channel][random_index]
-        
+    random_index = channel_quotes.random_position()
+    if random_index < 0:
+        return "Every quote has been deleted! sfhSAD"
 
-    while chosen_quote[0] == DELETED_FILL and chosen_quote[1] == DELETED_FILL:
-        random_index = randint(0, quote_count)
-        chosen_quote = quotes[channel][random_index]
+    chosen_quote = channel_quotes[random_index]
+    return chosen_quote.render() + INDEX_FORMAT.format(random_index + 1)
+
+def search_quotes(channel: str, terms: str, limit: int=SEARCH_RESULTS) -> list:
+    """Returns the numbers of up to 'limit' quotes containing every word in
+    'terms', best matches first.
+    """
+    return [position + 1 for position in quotes[channel].search(terms, limit)]
 
-    return QUOTE_FORMAT.format(*chosen_quote) + INDEX_FORMAT.format(random_index + 1)
 
 def save_all_quotes(channel: str) -> bool:
+    """Compacts a channel's journal into a fresh quotes file."""
     try:
-        channel_quotes = quotes[channel]
-        with open(os.path.join(quotes_directory, channel), 'w') as quotes_file:
-            for quote in channel_quotes:
-                quotes_file.write(SAVE_FORMAT.format(*quote))
+        storage.compact(channel, quotes[channel])
         return True
     except KeyError:
         return False
 
-# Nickname management-----------------------------------------------------------
-# Setting up storage
-nicknames_file_path = os.path.join(storage_directory, 'nicknames.txt')
-if 'nicknames.txt' not in os.listdir(storage_directory):
-    with open(nicknames_file_path, 'w') as nicknames_file:
-        nicknames_file.close()
 
+def _close_storage():
+    for channel in quotes:
+        if storage.has_journal(channel):
+            logger.info("Compacting quotes journal for: {}".format(channel))
+            save_all_quotes(channel)
+    storage.close()
 
+# Nickname management-----------------------------------------------------------
 # Load nicknames
-with open(nicknames_file_path, 'r') as nicknames_file:
-    for index, line in enumerate(nicknames_file.readlines()):
-        information = line.rsplit('=', 1)
-
-        if len(information) < 2:
-            warnings.warn(
-                "Issue loading nickname for line #{} in file '{}'!".format(
-                    index, nicknames_file_path
-                )
-            )
-            continue
-
-        channel = information[0].strip()
-        nickname = information[1].strip()
-
-        nicknames[channel] = nickname
-
-def save_nicknames():
-    with open(nicknames_file_path, 'w') as nicknames_file:
-        for channel in nicknames:
-            nicknames_file.write('{}={}\n'.format(channel, nicknames[channel]))
+nicknames.update(storage.load_nicknames())
 
 
 def set_nickname(new_nickname: str, channel: str):
     global nicknames
-    global quotes
 
     # Update channel quotes to use new nickname
-    update_these = quotes[channel]
-    current_nickname = get_streamer_nickname(channel)
-    for index, quote in enumerate(update_these):
-        if quote[1] == current_nickname:
-            update_these[index] = [quote[0], new_nickname, quote[-1]]
+    with quotes.channel_lock(channel):
+        update_these = quotes[channel]
+        current_nickname = get_streamer_nickname(channel)
+        changes = []
+        for index, quote in enumerate(update_these):
+            if quote.person == current_nickname:
+                changes.append(
+                    (index, Quote(quote.text, new_nickname, quote.date))
+                )
+
+        for index, quote in changes:
+            update_these.replace(index, quote)
 
-    quotes[channel] = update_these
-    save_all_quotes(channel)
+        if changes:
+            storage.update(channel, changes, update_these)
 
     # Set new nickname
     nicknames[channel] = new_nickname
-    save_nicknames()
+    storage.save_nickname(channel, new_nickname, nicknames)
 
 
 def get_streamer_nickname(channel: str) -> str:
@@ -364,24 +336,52 @@ def get_streamer_nickname(channel: str) -> str:
         return channel
 
 
-# Similarity tests--------------------------------------------------------------
-# TODO: Implement similarity tests.
-# NOTE: I can see this maybe getting annoying so it should be possible to toggle.
-# NOTE: We could respond with something like:
-#       "That quote is rather similar to quote #{} sfhHM ... Maybe you should
-#       take a look?"
-#       But still make the quote, just in case.
-"""
-def _quote_similarity(channel_name: str, quote_text: str) -> str:
-    if channel_quotes[channel_name]:
-        similarity = []
-        for quote in channel_quotes[channel_name]:
-            similarity.append(SequenceMatcher(None, quote[0], quote_text).ratio())
-
-        similarity_index, highest_similarity = max(enumerate(similarity), key=operator.itemgetter(1))
-        if highest_similarity == 1.0:
-            return "FeelsBadMan looks like your quote is already in the system. Check quote #{}".format(similarity_index)
-"""
+# Similarity checks-------------------------------------------------------------
+# New quotes are checked for being similar to an existing one. As this can get
+# annoying it can be turned off per channel, the quote is made either way.
+similarity_off_file_path = os.path.join(storage_directory, 'similarity_off.txt')
+similarity_off = set()
+
+
+def load_similarity_off() -> set:
+    if not os.path.exists(similarity_off_file_path):
+        return set()
+    with open(similarity_off_file_path, 'r') as similarity_file:
+        return {line.strip() for line in similarity_file if line.strip()}
+
+
+similarity_off.update(load_similarity_off())
+
+
+def set_similarity_check(channel: str, enabled: bool):
+    if enabled:
+        similarity_off.discard(channel)
+    else:
+        similarity_off.add(channel)
+
+    with locked_file(similarity_off_file_path):
+        # Other bot processes may have changed other channels
+        saved = load_similarity_off()
+        if enabled:
+            saved.discard(channel)
+        else:
+            saved.add(channel)
+        replace_file(similarity_off_file_path, ''.join(
+            '{}\n'.format(channel) for channel in sorted(saved)
+        ))
+
+
+def find_similar_quote(channel: str, quote_text: str) -> int:
+    """Returns the index of a quote similar to 'quote_text', or -1 if there is
+    none or the channel has turned similarity checks off. The first check after
+    a channel is loaded starts indexing it in the background, and finds nothing
+    until that's done.
+    """
+    if channel in similarity_off:
+        return -1
+
+    index, similarity = quotes[channel].find_similar(quote_text)
+    return index
 
 
 # Command functions-------------------------------------------------------------
@@ -391,58 +391,48 @@ def quote_count(user: IRC.User):
     number of quotes.
     """
 
-    try:
-        channel_quotes = quotes[user.chatted_from]
-    except KeyError:
-        logger.warning(
-            "Channel '{}' is missing from quotes dictionary!".format(user.chatted_from)
-        )
-        initialize_channels()
-        channel_quotes = quotes[user.chatted_from]
+    channel_quotes = quotes[user.chatted_from]
 
     if channel_quotes:
         # Getting number of quotes
         quote_count = len(channel_quotes)
 
         # Getting number of deleted quotes
-        deleted_count = 0
-        for quote in channel_quotes:
-            if quote[0] == "###DELETED###" and quote[1] == "###DELETED###":
-                deleted_count += 1
+        deleted_count = channel_quotes.deleted_count
 
         if quote_count - deleted_count == 0:
             if quote_count > 1:
-                IRC.chat("WutFace There are only deleted quotes, "
+                outbound.chat("WutFace There are only deleted quotes, "
                             "{} of them! WutFace".format(deleted_count),
                             user.chatted_from)
             elif quote_count == 1:
-                IRC.chat("WutFace There is only one quote and it was "
+                outbound.chat("WutFace There is only one quote and it was "
                             "deleted! WutFace", user.chatted_from)
 
         elif quote_count > 150:
-            IRC.chat(" NotLikeThis There are {} quotes and {} "
+            outbound.chat(" NotLikeThis There are {} quotes and {} "
                         "are deleted! Will they ever stop!? "
                         "NotLikeThis".format(quote_count, deleted_count),
                         user.chatted_from)
         elif quote_count > 100:
-            IRC.chat("\m/ SwiftRage \m/ {} quotes, {} were "
+            outbound.chat("\m/ SwiftRage \m/ {} quotes, {} were "
                         "burned at the stake! FUCK YEAH! "
                         "\m/ SwiftRage \m/".format(quote_count, deleted_count),
                         user.chatted_from)
         elif quote_count > 50:
-            IRC.chat("PogChamp there are {} quotes and {}"
+            outbound.chat("PogChamp there are {} quotes and {}"
                         " of those were deleted! "
                         "PogChamp".format(quote_count, deleted_count),
                         user.chatted_from)
         elif quote_count == 1:
-            IRC.chat("FeelsGoodMan there is 1 quote. FeelsGoodMan",
+            outbound.chat("FeelsGoodMan there is 1 quote. FeelsGoodMan",
                          user.chatted_from)
         else:
             if deleted_count == 1:
                 deleted_message = "1 was deleted!"
             else:
                 deleted_message = "{} were deleted".format(deleted_count)
-            IRC.chat(
+            outbound.chat(
                 "FeelsGoodMan there are {} quotes, of which {} "
                 "FeelsGoodMan".format(quote_count, deleted_message),
                 user.chatted_from)
@@ -453,48 +443,36 @@ def quote_count(user: IRC.User):
             )
         )
     else:
-        IRC.chat("FeelsBadMan there are no quotes. "
+        outbound.chat("FeelsBadMan there are no quotes. "
                     "FeelsGoodMan time to make some quotes!",
                     user.chatted_from)
 
 
-def quote_read(user: IRC.User):
-    try:
-        temp = quotes[user.chatted_from]
-    except KeyError:
-        initialize_channels()
-
-    parsed_input = re.findall(quote_read_regex, user.message)[0]
-
-    if not parsed_input:
+def quote_read(user: IRC.User, number: str=None):
+    if not number:
         random = True
     else:
         random = False
         try:
-            quote_number = int(parsed_input.strip())
+            quote_number = int(number.strip())
         except ValueError:
-            user.send_message("sfhWUT Not even sure what you're trying to do.")
+            outbound.send_message(user, "sfhWUT Not even sure what you're trying to do.")
             return
 
     if random:
-        IRC.chat(get_random_quote(user.chatted_from), user.chatted_from)
+        outbound.chat(get_random_quote(user.chatted_from), user.chatted_from)
     else:
-        IRC.chat(get_quote(user.chatted_from, quote_number) , user.chatted_from)
+        outbound.chat(get_quote(user.chatted_from, quote_number) , user.chatted_from)
 
 
 # TODO: I think my use of the "too_large" variable makes it so that the original
 #       quote is not re-written to the file. This causes it to be deleted, which
 #       is not what the _quote_edit() function should be doing...
-def quote_edit(user: IRC.User):
-    if not quotes:
-        initialize_channels()
-
-    parsed_input = re.findall(quote_edit_regex, user.message)[0]
-
+def quote_edit(user: IRC.User, number: str, option: str, text: str):
     broadcaster_nickname = get_streamer_nickname(user.chatted_from)
     
     try:
-        index = int(parsed_input[0])
+        index = int(number)
     except ValueError: # This shouldn't ever be triggered, but... Gotta be safe.
         return  # NOTE: Maybe log something?
 
@@ -507,25 +485,20 @@ def quote_edit(user: IRC.User):
     try:
         quote_copy = quotes[user.chatted_from][copy_index]
     except IndexError:
-        user.send_message("Quote #{} does not exist".format(index))
+        outbound.send_message(user, "Quote #{} does not exist".format(index))
         return
 
-    quoted_person =  quote_copy[-2]
-    date = quote_copy[-1]
-    quote_text = manage_spacing(parsed_input[-1], user)
+    quoted_person = quote_copy.person
+    date = quote_copy.date
+    quote_text = manage_spacing(text, user)
 
     # Parse any options
-    for option in parsed_input:
-        if '--name=' in option:
-            try:
-                broadcaster_nickname = option.split('=', 1)[1]
-            except IndexError:
-                # TODO: Log issue with option being wrong
-                break  # NOTE Remember to remove this if I add more options!
+    if option and '--name=' in option:
+        broadcaster_nickname = option.split('=', 1)[1]
 
     was_deleted = False
     # Check if the quote was previously deleted
-    if quoted_person == DELETED_FILL:
+    if quote_copy.is_deleted:
         was_deleted = True
         # Update with a new name for the person being quoted
         quoted_person = broadcaster_nickname
@@ -533,11 +506,12 @@ def quote_edit(user: IRC.User):
         # Update the date, as this is a new quote
         date = datetime.datetime.now().date()
 
-    if len(quote_text) + len(quoted_person) + len(str(date)) + SIZE_OFFSET > MAX_SIZE:
-        user.send_message("Your quote was too large, please shorten it! sfhMAD")
+    # Dates are rendered as YYYY-MM-DD
+    if len(quote_text) + len(quoted_person) + 10 + SIZE_OFFSET > MAX_SIZE:
+        outbound.send_message(user, "Your quote was too large, please shorten it! sfhMAD")
     else:
         # Update to the new quote
-        new_quote = [quote_text, quoted_person, date]
+        new_quote = Quote(quote_text, quoted_person, date)
         edit_quote(user.chatted_from, index, new_quote)
 
         if was_deleted:
@@ -547,7 +521,7 @@ def quote_edit(user: IRC.User):
                 "{} has edited quote #{}, which was previously deleted, "
                 "in channel '{}': {}".format(
                     user.name, index, user.chatted_from, 
-                    QUOTE_FORMAT.format(*new_quote)
+                    new_quote.render()
                 )
             )
         else:
@@ -556,25 +530,19 @@ def quote_edit(user: IRC.User):
             logger.info(
                 "{} has edited quote #{} in channel '{}': {} -> {}".format(
                     user.name, index, user.chatted_from,
-                    QUOTE_FORMAT.format(*quote_copy),
-                    QUOTE_FORMAT.format(*new_quote)
+                    quote_copy.render(),
+                    new_quote.render()
                 )
             )
 
-        user.send_message(message)
+        outbound.send_message(user, message)
 
 
 # TODO: WHen new system is implemented. Use twitch.user.emotes[] and find the start and end of each emote. If one
 #       starts at 0 or ends at the very last character of the quote, add a space to the left or right respectively.
-def quote_add(user: IRC.User):
-    if not quotes:
-        initialize_channels()
-
-
-    parsed_input = re.findall(quote_add_regex, user.message)[0]
-
+def quote_add(user: IRC.User, option: str, text: str):
     # Set the new quote
-    new_quote = manage_spacing(parsed_input[-1].strip(), user)
+    new_quote = manage_spacing(text.strip(), user)
 
     # Set the date
     quote_date = datetime.datetime.now().date()
@@ -583,71 +551,107 @@ def quote_add(user: IRC.User):
     quoted_person = get_streamer_nickname(user.chatted_from)
 
     # Check if user input a different name for the quoted person.
-    for option in parsed_input:
-        if '-name=' in option:
-            try:
-                quoted_person = option.split('=', 1)[1]
-            except IndexError:
-                pass
+    if option and '-name=' in option:
+        quoted_person = option.split('=', 1)[1]
 
     # Checking if new quote is too large
     if len(new_quote) + len(quoted_person) + len(str(quote_date)) + SIZE_OFFSET > MAX_SIZE:
-        user.send_message("Your new quote was too large, please shorten it! "
+        outbound.send_message(user, "Your new quote was too large, please shorten it! "
                           "sfhMAD")
         return
 
-    # Initialize quotes list for channel if not already available
-    if user.chatted_from not in quotes.keys():
-        quotes[user.chatted_from] = []
+    full_quote = Quote(new_quote, quoted_person, quote_date)
+    with quotes.channel_lock(user.chatted_from):
+        channel_quotes = quotes[user.chatted_from]
 
-    # Check if that quote was already made before.
-    for index, quote in enumerate(quotes[user.chatted_from]):
-        if new_quote.strip().lower() == quote[0].strip().lower():
-            user.send_message("That quote is the same as quote #{}! "
+        # Check if that quote was already made before.
+        index = channel_quotes.find(new_quote)
+        if index >= 0:
+            outbound.send_message(user, "That quote is the same as quote #{}! "
                               "sfhPLS".format(index + 1))
             return
-    
-    add_quote(user.chatted_from, [new_quote, quoted_person, quote_date])
-    
+
+        similar_index = find_similar_quote(user.chatted_from, new_quote)
+        position = add_quote(user.chatted_from, full_quote)
+
     logger.info("User {}, in channel {}, has created quote #{}: {}".format(
-        user.name, user.chatted_from, len(quotes[user.chatted_from]), 
-        QUOTE_FORMAT.format(*quotes[user.chatted_from][-1])
+        user.name, user.chatted_from, position + 1, full_quote.render()
     ))
-    user.send_message("Quote #{} has been created! sfhWOW".format(len(quotes[user.chatted_from])))
+    message = "Quote #{} has been created! sfhWOW".format(position + 1)
+    if similar_index >= 0:
+        message += (
+            " It is rather similar to quote #{} sfhHM ... Maybe you should "
+            "take a look?".format(similar_index + 1)
+        )
+    outbound.send_message(user, message)
 
 
-def quote_delete(user: IRC.User):
+def quote_delete(user: IRC.User, number: str):
     """
     Overwrites a quote with data relating to the deletion, including saving the
     date of deletion.
     """
-    if not quotes:
-        initialize_channels()
-
-    parsed_input = re.findall(quote_delete_regex, user.message)[0]
+    index = int(number)
+    outbound.send_message(user, delete_quote(user.chatted_from, index, user.name))
 
-    index = int(parsed_input)
-    user.send_message(delete_quote(user.chatted_from, index, user.name))
 
-
-def quote_set_nickname(user: IRC.User):
-    parsed_input = re.findall(quote_set_nickname_regex, user.message)[0]
-    print(parsed_input)
-    set_nickname(parsed_input, user.chatted_from)
-    user.send_message("Nickname has been changed to '{}'".format(parsed_input))
+def quote_set_nickname(user: IRC.User, nickname: str):
+    set_nickname(nickname, user.chatted_from)
+    outbound.send_message(user, "Nickname has been changed to '{}'".format(nickname))
     logger.info(
         "User '{}' has changed the nickname of channel '{}' to '{}'".format(
-            user.name, user.chatted_from, parsed_input
+            user.name, user.chatted_from, nickname
         )
     )
     
+def quote_search(user: IRC.User, terms: str):
+    results = search_quotes(user.chatted_from, terms, SEARCH_RESULTS + 1)
+
+    if not results:
+        outbound.send_message(user, "No quotes found for '{}' sfhHM".format(terms))
+        return
+
+    message = quotes[user.chatted_from][results[0] - 1].render() + \
+        INDEX_FORMAT.format(results[0])
+    if len(results) > 1:
+        message += " (Also: {})".format(
+            ', '.join('#{}'.format(number) for number in results[1:])
+        )
+
+    outbound.chat(message, user.chatted_from)
+    logger.info(
+        "User '{}' searched for '{}' in channel '{}', found: {}".format(
+            user.name, terms, user.chatted_from, results
+        )
+    )
+
+
+def quote_similarity(user: IRC.User, setting: str):
+    enabled = setting == "on"
+
+    set_similarity_check(user.chatted_from, enabled)
+    if enabled:
+        outbound.send_message(user, "New quotes will be checked for similar quotes.")
+    else:
+        outbound.send_message(user, "New quotes will no longer be checked for similar quotes.")
+    logger.info(
+        "User '{}' has turned similarity checks {} in channel '{}'".format(
+            user.name, setting, user.chatted_from
+        )
+    )
+
 # Registering commands----------------------------------------------------------
-module_tools.register_command(r'quotes', quote_count)
-module_tools.register_command(quote_read_regex , quote_read)
-module_tools.register_command(quote_add_regex , quote_add, "moderator")
-module_tools.register_command(quote_edit_regex, quote_edit, "moderator")
-module_tools.register_command(quote_delete_regex, quote_delete, "moderator")
-module_tools.register_command(quote_set_nickname_regex, quote_set_nickname, "moderator")
+router.register_command(r'quotes', quote_count)
+router.register_command(quote_read_regex , quote_read)
+router.register_command(quote_search_regex, quote_search)
+router.register_command(quote_add_regex , quote_add, "moderator")
+router.register_command(quote_edit_regex, quote_edit, "moderator")
+router.register_command(quote_delete_regex, quote_delete, "moderator")
+router.register_command(quote_set_nickname_regex, quote_set_nickname, "moderator")
+router.register_command(quote_similarity_regex, quote_similarity, "moderator")
 
 # Reserving command names
 module_tools.reserve_general_commands(RESERVED_COMMAND_NAMES)
+
+# Registering shutdown functions
+module_tools.register_shutdown_function(_close_storage)
@@ -0,0 +1,185 @@
+"""
+Description:
+Routes chat commands to the module functions that handle them.
+
+Modules register their commands here rather than with module_tools, using the
+same arguments. Every pattern is compiled once, and filed in a trie under the
+words it starts with, so "deathcount set game (.+)" is filed under "deathcount",
+then "set", then "game". A message is only matched against the patterns filed
+under its own first words, deepest first, and anything that doesn't start with
+the command prefix is turned away without looking any further.
+
+Handlers are called with the user followed by the pattern's groups, so they
+don't have to parse the message again. Groups that didn't match are None.
+
+User levels and cooldowns are checked with cooldowns.py.
+"""
+
+# Imports-----------------------------------------------------------------------
+import re
+import spicytwitch
+from . import cooldowns
+
+# Global Variables--------------------------------------------------------------
+module_tools = spicytwitch.bot.modules
+PREFIX = module_tools.DEFAULT_COMMAND_PREFIX
+
+# Seconds before a command may be used again in the same channel, when it's
+# registered without cooldowns. Moderators and everyone else are timed
+# separately.
+DEFAULT_MOD_COOLDOWN = 5
+DEFAULT_EVERYONE_COOLDOWN = 30
+
+# Characters that end the literal start of a pattern
+_SPECIAL = set("\\.^$*+?{}[]|()")
+_QUANTIFIERS = set("*+?{")
+
+logger = spicytwitch.log_tools.create_logger()
+
+
+# Routes------------------------------------------------------------------------
+class Route:
+    __slots__ = (
+        "pattern", "regex", "handler", "level", "rank", "cooldowns"
+    )
+
+    def __init__(self, pattern: str, handler, level: str, mod_cooldown: float,
+                 everyone_cooldown: float):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.handler = handler
+        self.level = level
+        self.rank = cooldowns.level_rank(level)
+        # Indexed by cooldown group
+        self.cooldowns = [0.0] * cooldowns.GROUPS
+        self.cooldowns[cooldowns.GROUP_EVERYONE] = everyone_cooldown
+        self.cooldowns[cooldowns.GROUP_MODERATOR] = mod_cooldown
+
+
+class _Node:
+    __slots__ = ("children", "routes")
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+
+def literal_words(pattern: str) -> list:
+    """Returns the whole words a pattern always starts with.
+
+    "quote( \\d+)?" starts with "quote", as the group begins with a space, but
+    "quotes?" doesn't start with any whole word.
+    """
+    depth = 0
+    escaped = False
+    for character in pattern:
+        if escaped:
+            escaped = False
+        elif character == '\\':
+            escaped = True
+        elif character in "([":
+            depth += 1
+        elif character in ")]":
+            depth -= 1
+        elif character == '|' and depth == 0:
+            # Alternatives at the top level may start with anything
+            return []
+
+    end = 0
+    while end < len(pattern) and pattern[end] not in _SPECIAL:
+        end += 1
+    literal, rest = pattern[:end], pattern[end:]
+
+    if rest[:1] in _QUANTIFIERS:
+        # The quantifier applies to the last character
+        literal, rest = literal[:-1], literal[-1:] + rest
+
+    words = literal.split(' ')
+    if rest and not literal.endswith(' ') and not rest.startswith('( '):
+        # The last word carries on into the rest of the pattern
+        words.pop()
+    return [word for word in words if word]
+
+
+# Router------------------------------------------------------------------------
+class Router:
+    def __init__(self):
+        self.root = _Node()
+
+    def register(self, route: Route):
+        node = self.root
+        for word in literal_words(route.pattern):
+            try:
+                node = node.children[word]
+            except KeyError:
+                node.children[word] = _Node()
+                node = node.children[word]
+        node.routes.append(route)
+
+    def match(self, text: str):
+        """Returns the route and match for a command without its prefix, or
+        (None, None).
+        """
+        nodes = [self.root]
+        node = self.root
+        for word in text.split(' '):
+            node = node.children.get(word)
+            if node is None:
+                break
+            nodes.append(node)
+
+        for node in reversed(nodes):
+            for route in node.routes:
+                match = route.regex.fullmatch(text)
+                if match:
+                    return route, match
+        return None, None
+
+    def route(self, user: spicytwitch.irc.User) -> bool:
+        message = user.message
+        if not message.startswith(PREFIX):
+            return False
+
+        route, match = self.match(message[len(PREFIX):].strip())
+        if route is None:
+            return False
+
+        rank = cooldowns.user_rank(user)
+        group = cooldowns.cooldown_group(rank)
+        if rank < route.rank:
+            logger.debug("{} may not use '{}'".format(user.name, route.pattern))
+        elif not cooldowns.check(
+                user.chatted_from, route, group, route.cooldowns[group]):
+            logger.debug("'{}' is on cooldown in channel '{}'".format(
+                route.pattern, user.chatted_from
+            ))
+        else:
+            route.handler(user, *match.groups())
+        return True
+
+
+router = Router()
+
+
+# Outer interface---------------------------------------------------------------
+def register_command(pattern: str, handler, level: str="everyone",
+                     mod_cooldown: float=DEFAULT_MOD_COOLDOWN,
+                     everyone_cooldown: float=DEFAULT_EVERYONE_COOLDOWN):
+    """Registers a handler for a command, takes the same arguments as
+    module_tools.register_command.
+    """
+    router.register(
+        Route(pattern, handler, level, mod_cooldown, everyone_cooldown)
+    )
+
+
+def command_exists(name: str) -> bool:
+    """Returns True if any registered command starts with the word 'name'."""
+    return name in router.root.children
+
+
+def route(user: spicytwitch.irc.User) -> bool:
+    """Calls the handler for a user's command. Returns False if the message
+    wasn't one of the registered commands, so it can be handled elsewhere.
+    """
+    return router.route(user)
@@ -1,15 +1,50 @@
+"""
+Description:
+Lets viewers offer themselves as a sacrifice, and moderators pick one.
+
+Sacrifices only last for the day. A timer empties every channel's sacrifices
+at midnight, so messages never have to check the date. Sacrifices are saved to
+a snapshot file a few seconds after they change, and when the bot shuts down,
+so a restart doesn't lose them.
+
+With BATCH_JOINS, '!sacrificeme' only queues the user, and everyone queued in a
+channel is added together once BATCH_WINDOW has passed. A flood of joins then
+takes one log line, and at most one chat message, rather than one per viewer.
+"""
+
 # Imports-----------------------------------------------------------------------
-import re
+import os
+import json
 import datetime
-from random import choice
+import threading
+from random import random, randrange
 import spicytwitch
+from . import outbound, router, storage
 
 # Global Variables--------------------------------------------------------------
-# Decided to use a local variable for storage instead of the module_tools
-# storage system since I don't intend to have any of this data saved. The one
-# downside is that now I have to manage channels myself.
+# Channel -> Sacrifices. 'lock' guards it and every channel's pools.
 sacrifices = {}
-today = None
+lock = threading.RLock()
+
+SNAPSHOT_NAME = "sacrifices.json"
+
+# Seconds after a change before the snapshot is saved, so a flood of
+# !sacrificeme is saved once.
+SNAPSHOT_DELAY = 10.0
+
+# Whether joins are queued and added in batches, how many seconds a batch
+# gathers joins for, and whether to say in chat how many joined.
+BATCH_JOINS = True
+BATCH_WINDOW = 2.0
+ACKNOWLEDGE_BATCHES = False
+
+# Each channel's sacrifices are split into these groups.
+GROUPS = ('subs', 'mods', 'everyone_else')
+
+# How likely a member of each group is to be picked by '!sacrifice', compared
+# to everyone else. A weight of 2 for subs makes each sub twice as likely to be
+# picked as anyone who isn't one.
+GROUP_WEIGHTS = {'subs': 1.0, 'mods': 1.0, 'everyone_else': 1.0}
 
 module_tools = spicytwitch.bot.modules
 IRC = spicytwitch.irc
@@ -26,88 +61,362 @@ reset_regex = r"sacrifice reset"
 # Module Registration-----------------------------------------------------------
 module_tools.register_command_module()
 
+storage_directory = module_tools.get_storage_directory()
+
 # Getting a logger
 logger = spicytwitch.log_tools.create_logger()
 
 
-# Ease of use-------------------------------------------------------------------
-def check_channel(channel: str):
-    global sacrifices
-
-    if channel not in sacrifices.keys():
-        sacrifices[channel] = {'subs': [], 'mods': [], 'everyone_else': []}
-
-# TODO: Implement this in code!
-def check_day(channel: str):
-    global today
-    global sacrifices
-    
-    current_date = datetime.datetime.today()
-    if today is not current_date:
-        del sacrifices[channel]  # Remove the channel from the sacrifices dict.
-        check_channel(channel)  # Add back the channel.
-
-        today = current_date
-    
-def is_in_sacrifices(username: str, channel: str):
-    sacrifice_list = sacrifices[channel]
-    username = username.lower()
-
-    if username in sacrifice_list['subs']:
-        return True
-    elif username in sacrifice_list['mods']:
+# Pools-------------------------------------------------------------------------
+class Pool:
+    """A group of usernames in no particular order.
+
+    'positions' maps each name to its index in 'names', and removing a name
+    moves the last name into its place, so adding, removing, checking for and
+    picking a random name all take constant time.
+    """
+    __slots__ = ("names", "positions")
+
+    def __init__(self):
+        self.names = []
+        self.positions = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.positions
+
+    def add(self, name: str) -> bool:
+        """Returns False if the name was already in the pool."""
+        if name in self.positions:
+            return False
+        self.positions[name] = len(self.names)
+        self.names.append(name)
         return True
-    elif username in sacrifice_list['everyone_else']:
+
+    def remove(self, name: str) -> bool:
+        """Returns False if the name wasn't in the pool."""
+        position = self.positions.pop(name, None)
+        if position is None:
+            return False
+        last = self.names.pop()
+        if position < len(self.names):
+            self.names[position] = last
+            self.positions[last] = position
         return True
-    else:
-        return False
 
-# Command functions-------------------------------------------------------------
-def sacrifice_me(user: IRC.User):
-    check_channel(user.chatted_from)
+    def choice(self) -> str:
+        return self.names[randrange(len(self.names))]
+
+
+class Sacrifices:
+    """A channel's sacrifices, one Pool per group, and the day (as an ordinal)
+    they were made on.
+    """
+    __slots__ = ("pools", "day")
+
+    def __init__(self, day: int=None):
+        self.pools = {group: Pool() for group in GROUPS}
+        self.day = datetime.date.today().toordinal() if day is None else day
+
+    def __len__(self) -> int:
+        return sum(len(pool) for pool in self.pools.values())
+
+    def __contains__(self, name: str) -> bool:
+        return any(name in pool for pool in self.pools.values())
+
+    def add(self, name: str, group: str) -> bool:
+        """Returns False if the name was already in any group."""
+        if name in self:
+            return False
+        return self.pools[group].add(name)
+
+    def remove(self, name: str) -> bool:
+        return any(pool.remove(name) for pool in self.pools.values())
+
+    def choice(self, group: str=None) -> str:
+        """Returns a random name, or None if there are none to pick from.
+
+        With a group, every member of it is equally likely. Without one, a
+        group is picked by its size times its weight in GROUP_WEIGHTS, then a
+        member of it, so the groups are never joined into one list.
+        """
+        if group is not None:
+            pool = self.pools[group]
+            return pool.choice() if pool else None
+
+        weights = [
+            (len(pool) * GROUP_WEIGHTS[name], pool)
+            for name, pool in self.pools.items()
+        ]
+        point = random() * sum(weight for weight, pool in weights)
+        chosen = None
+        for weight, pool in weights:
+            if weight <= 0:
+                continue
+            chosen = pool
+            if point < weight:
+                break
+            point -= weight
+        # Rounding can leave the point just past the last pool
+        return chosen.choice() if chosen else None
+
+
+# Snapshots---------------------------------------------------------------------
+# The snapshot holds {channel: [day, subs, mods, everyone_else]}. Only the
+# channels changed since the last save are written, merged into the file under
+# a lock, as other bot processes save their own channels to the same file.
+snapshot_path = os.path.join(storage_directory, SNAPSHOT_NAME)
+snapshot_timer = None
+changed_channels = set()
+
+# snapshot_lock makes snapshots save one at a time.
+snapshot_lock = threading.Lock()
+
+
+def read_snapshot() -> dict:
+    try:
+        with open(snapshot_path, 'r', encoding='utf-8') as snapshot_file:
+            return json.load(snapshot_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as error:
+        logger.warning("Could not read '{}': {}".format(snapshot_path, error))
+        return {}
+
+
+def save_snapshot():
+    global snapshot_timer
+
+    with snapshot_lock:
+        with lock:
+            if snapshot_timer is not None:
+                snapshot_timer.cancel()
+                snapshot_timer = None
+
+            changes = {}
+            for channel in changed_channels:
+                channel_sacrifices = sacrifices.get(channel)
+                if channel_sacrifices:
+                    changes[channel] = [channel_sacrifices.day] + [
+                        list(channel_sacrifices.pools[group].names)
+                        for group in GROUPS
+                    ]
+                else:
+                    changes[channel] = None
+            changed_channels.clear()
+
+        if not changes:
+            return
+        try:
+            with storage.locked_file(snapshot_path):
+                snapshot = read_snapshot()
+                for channel, entry in changes.items():
+                    if entry is None:
+                        snapshot.pop(channel, None)
+                    else:
+                        snapshot[channel] = entry
+                storage.replace_file(
+                    snapshot_path, json.dumps(snapshot, separators=(',', ':'))
+                )
+        except OSError as error:
+            logger.error("Could not save sacrifices: {}".format(error))
 
-    global sacrifices
 
-    subs = sacrifices[user.chatted_from]['subs']
-    mods = sacrifices[user.chatted_from]['mods']
+def _schedule_snapshot(channels):
+    global snapshot_timer
+
+    with lock:
+        changed_channels.update(channels)
+        if snapshot_timer is None:
+            snapshot_timer = threading.Timer(SNAPSHOT_DELAY, save_snapshot)
+            snapshot_timer.daemon = True
+            snapshot_timer.start()
+
+
+def load_snapshot():
+    """Loads the sacrifices saved before the last shutdown, leaving out any
+    from before today.
+    """
+    today = datetime.date.today().toordinal()
+    loaded = 0
+    with lock:
+        for channel, (day, *groups) in read_snapshot().items():
+            if day < today:
+                continue
+            channel_sacrifices = Sacrifices(day)
+            for group, names in zip(GROUPS, groups):
+                for name in names:
+                    channel_sacrifices.add(name, group)
+            sacrifices[channel] = channel_sacrifices
+            loaded += len(channel_sacrifices)
+
+    logger.info("Loaded {} sacrifices in {} channels.".format(
+        loaded, len(sacrifices)
+    ))
+
+
+# Daily rollover----------------------------------------------------------------
+rollover_timer = None
+
+
+def _schedule_rollover():
+    global rollover_timer
+
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time()
+    )
+    rollover_timer = threading.Timer(
+        (midnight - now).total_seconds(), rollover
+    )
+    rollover_timer.daemon = True
+    rollover_timer.start()
+
+
+def rollover():
+    """Empties every channel's sacrifices made before today, then waits for
+    the next midnight.
+    """
+    today = datetime.date.today().toordinal()
+    with lock:
+        expired = [
+            channel for channel, channel_sacrifices in sacrifices.items()
+            if channel_sacrifices.day < today
+        ]
+        for channel in expired:
+            del sacrifices[channel]
+
+    if expired:
+        logger.info("Cleared yesterday's sacrifices in {} channels.".format(
+            len(expired)
+        ))
+        _schedule_snapshot(expired)
+    # If the timer went off a moment early, this is just a moment away
+    _schedule_rollover()
+
+
+# Batched joins----------------------------------------------------------------
+# Channel -> [(username, group)] waiting to be added. 'batch_lock' guards it
+# and the timer, and is held until a popped batch is added, so a reset never
+# runs between the two. Take it before 'lock', never while holding 'lock'.
+pending_joins = {}
+batch_lock = threading.Lock()
+batch_timer = None
+
+
+def queue_join(channel: str, name: str, group: str):
+    global batch_timer
+
+    with batch_lock:
+        try:
+            pending_joins[channel].append((name, group))
+        except KeyError:
+            pending_joins[channel] = [(name, group)]
+
+        if batch_timer is None:
+            batch_timer = threading.Timer(BATCH_WINDOW, apply_joins)
+            batch_timer.daemon = True
+            batch_timer.start()
+
+
+def apply_joins(channel: str=None):
+    """Adds the queued joins of one channel, or of every channel."""
+    global batch_timer
+
+    with batch_lock:
+        if channel is None:
+            if batch_timer is not None:
+                batch_timer.cancel()
+                batch_timer = None
+            batches = list(pending_joins.items())
+            pending_joins.clear()
+        elif channel in pending_joins:
+            batches = [(channel, pending_joins.pop(channel))]
+        else:
+            return
+
+        results = []
+        with lock:
+            for channel, joins in batches:
+                channel_sacrifices = check_channel(channel)
+                added = sum(
+                    channel_sacrifices.add(name, group) for name, group in joins
+                )
+                results.append((channel, added, len(joins)))
+
+    added_channels = []
+    for channel, added, queued in results:
+        if not added:
+            continue
+
+        added_channels.append(channel)
+        logger.info("Added {} of {} queued sacrifices in channel '{}'.".format(
+            added, queued, channel
+        ))
+        if ACKNOWLEDGE_BATCHES:
+            outbound.chat("+{} new sacrifice{}".format(
+                added, "" if added == 1 else "s"
+            ), channel)
+
+    if added_channels:
+        _schedule_snapshot(added_channels)
+
+
+def _shutdown():
+    if rollover_timer is not None:
+        rollover_timer.cancel()
+    apply_joins()
+    save_snapshot()
 
-    if is_in_sacrifices(user.name, user.chatted_from):
-        return
 
+# Ease of use-------------------------------------------------------------------
+def check_channel(channel: str) -> Sacrifices:
+    """Returns a channel's sacrifices, call with 'lock' held."""
+    try:
+        return sacrifices[channel]
+    except KeyError:
+        sacrifices[channel] = Sacrifices()
+        return sacrifices[channel]
+
+
+def user_group(user: IRC.User) -> str:
     if user.is_mod:
-        logger.info("Adding '{}' to mods sacrifice list for channel '{}'.".format(
-                user.name, user.chatted_from
-            )
-        )
-        sacrifices[user.chatted_from]['mods'].append(user.name.lower())
-    elif user.is_sub:
-        logger.info("Adding '{}' to sub sacrifice list for channel '{}'.".format(
-                user.name, user.chatted_from
-            )
-        )
-        sacrifices[user.chatted_from]['subs'].append(user.name.lower())
-    else:
-        logger.info("Adding '{}' to everyone_else sacrifice list for channel '{}'.".format(
-                user.name, user.chatted_from
+        return 'mods'
+    if user.is_sub:
+        return 'subs'
+    return 'everyone_else'
+
+
+# Command functions-------------------------------------------------------------
+def sacrifice_me(user: IRC.User):
+    group = user_group(user)
+    if BATCH_JOINS:
+        queue_join(user.chatted_from, user.name.lower(), group)
+        return
+
+    with lock:
+        added = check_channel(user.chatted_from).add(user.name.lower(), group)
+
+    if added:
+        _schedule_snapshot([user.chatted_from])
+        logger.info("Adding '{}' to {} sacrifice list for channel '{}'.".format(
+                user.name, group, user.chatted_from
             )
         )
-        sacrifices[user.chatted_from]['everyone_else'].append(user.name.lower())
 
 
 def sacrifice_count(user: IRC.User):
-    check_channel(user.chatted_from)
-
-    subs = sacrifices[user.chatted_from]['subs']
-    mods = sacrifices[user.chatted_from]['mods']
-    everyone = sacrifices[user.chatted_from]['everyone_else'] + subs + mods
-
-    count = len(everyone)
+    apply_joins(user.chatted_from)
+    with lock:
+        count = len(check_channel(user.chatted_from))
     if count <= 0:  # Should never be less than Zero, but I'd rather be safe.
-        user.send_message("Nobody has offered themselves as a sacrifice.")
+        outbound.send_message(user, "Nobody has offered themselves as a sacrifice.")
     elif count == 1:
-        IRC.chat("There is 1 soon-to-be sacrifice!", user.chatted_from)
+        outbound.chat("There is 1 soon-to-be sacrifice!", user.chatted_from)
     else:
-        IRC.chat(
+        outbound.chat(
             "There are {} soon-to-be sacrifices!".format(count),user.chatted_from
         )
 
@@ -118,66 +427,60 @@ def sacrifice_count(user: IRC.User):
 
 
 def sacrifice_reset(user: IRC.User):
-    check_channel(user.chatted_from)
-
-    sacrifices[user.chatted_from] = {
-        'subs': [], 'mods': [], 'everyone_else': []
-    }
+    with batch_lock:
+        pending_joins.pop(user.chatted_from, None)
+        with lock:
+            sacrifices.pop(user.chatted_from, None)
+    _schedule_snapshot([user.chatted_from])
 
-    user.send_message("List of sacrifices has been cleared.")
+    outbound.send_message(user, "List of sacrifices has been cleared.")
     logger.info("Sacrifice list has been cleared by '{}' in channel '{}'".format(
             user.name, user.chatted_from
         )
     )
 
 
-def sacrifice(user: IRC.User):
-    check_channel(user.chatted_from)
-
-    parsed_input = re.findall(main_regex, user.message)[0]
-
-    if parsed_input:
-        option = parsed_input.lower().strip()
+def sacrifice(user: IRC.User, option: str=None):
+    if option:
+        option = option.lower().strip()
     else:
         option = ''
 
-    print(option)
-
-    subs = sacrifices[user.chatted_from]['subs']
-    mods = sacrifices[user.chatted_from]['mods']
-    everyone = sacrifices[user.chatted_from]['everyone_else'] + subs + mods
+    apply_joins(user.chatted_from)
+    with lock:
+        channel_sacrifices = check_channel(user.chatted_from)
+        if option in ('subs', 'mods'):
+            todays_sacrifice = channel_sacrifices.choice(option)
+        else:
+            todays_sacrifice = channel_sacrifices.choice()
 
-    todays_sacrifice = ''
     if option:
         if option == 'subs':
-            if subs:
-                todays_sacrifice = choice(subs)
-                user.send_message(
-                    "Subscriber sacrifice is @{}".format(todays_sacrifice)
+            if todays_sacrifice:
+                outbound.send_message(
+                    user, "Subscriber sacrifice is @{}".format(todays_sacrifice)
                 )
             else:
-                user.send_message(
-                    "No subscribers have offered themselves as a sacrifice."
+                outbound.send_message(
+                    user, "No subscribers have offered themselves as a sacrifice."
                 )
         elif option == 'mods':
-            if subs:
-                todays_sacrifice = choice(mods)
-                user.send_message(
-                    "Moderator sacrifice is @{}".format(todays_sacrifice)
+            if todays_sacrifice:
+                outbound.send_message(
+                    user, "Moderator sacrifice is @{}".format(todays_sacrifice)
                 )
             else:
-                user.send_message(
-                    "No moderators have offered themselves as a sacrifice."
+                outbound.send_message(
+                    user, "No moderators have offered themselves as a sacrifice."
                 )
     else:
-        if everyone:
-            todays_sacrifice = choice(everyone)
-            user.send_message(
-                "Today's sacrifice is @{}".format(todays_sacrifice)
+        if todays_sacrifice:
+            outbound.send_message(
+                user, "Today's sacrifice is @{}".format(todays_sacrifice)
             )
         else:
-            user.send_message(
-                "Nobody has offered themselves as a sacrifice."
+            outbound.send_message(
+                user, "Nobody has offered themselves as a sacrifice."
             )
 
     if todays_sacrifice:
@@ -187,11 +490,15 @@ def sacrifice(user: IRC.User):
         )
 
 # Registering Commands----------------------------------------------------------
-module_tools.register_command(main_regex, sacrifice, "moderator", mod_cooldown=5)
-module_tools.register_command(reset_regex, sacrifice_reset, "moderator")
-module_tools.register_command("sacrifices", sacrifice_count)
-module_tools.register_command(
+router.register_command(main_regex, sacrifice, "moderator", mod_cooldown=5)
+router.register_command(reset_regex, sacrifice_reset, "moderator")
+router.register_command("sacrifices", sacrifice_count)
+router.register_command(
     "sacrificeme", sacrifice_me, everyone_cooldown=0, mod_cooldown=0
 )
 
 module_tools.reserve_general_commands(reserved_commands)
+module_tools.register_shutdown_function(_shutdown)
+
+load_snapshot()
+_schedule_rollover()
@@ -0,0 +1,223 @@
+"""
+Description:
+SQLite connections shared by the modules, safe to use from any thread.
+
+Each database gets one ConnectionPool, from open_pool(). A thread takes a
+connection from the pool for the length of a 'with pool.connection()' block,
+and blocks nested inside it on the same thread get that same connection, so
+they are part of the same transaction. The outermost block commits when it
+ends, or rolls back if it raised.
+
+Connections are reused rather than opened for every block, and each keeps a
+cache of its prepared statements, so running the same query again doesn't
+parse it again. At most 'max_connections' are open per database; once they're
+all in use other threads wait for one to be returned.
+
+Files that several bot processes rewrite as a whole, such as the quote
+nicknames, are changed inside 'with locked_file(path)', which holds a lock on
+"<path>.lock" so another process can't rewrite the file at the same time.
+"""
+
+# Imports-----------------------------------------------------------------------
+import os
+import sqlite3
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where only one process is run
+    fcntl = None
+
+# Global Variables--------------------------------------------------------------
+MAX_CONNECTIONS = 8
+
+# Seconds to wait for a free connection, and for another connection's write
+# lock on the database, before giving up.
+POOL_TIMEOUT = 30.0
+BUSY_TIMEOUT = 10.0
+
+# Number of prepared statements each connection keeps.
+CACHED_STATEMENTS = 256
+
+# With WAL, readers don't wait on a writer, and with synchronous=NORMAL a commit
+# doesn't wait on the disk. A power loss can only lose the last few commits.
+DEFAULT_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+)
+
+
+# Connection pool---------------------------------------------------------------
+class ConnectionPool:
+    def __init__(self, path: str, max_connections: int=MAX_CONNECTIONS,
+                 pragmas: tuple=DEFAULT_PRAGMAS):
+        self.path = path
+        self.max_connections = max_connections
+        self.pragmas = pragmas
+
+        self.idle = []
+        self.opened = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # The connection the current thread holds, and how deeply nested
+        self.local = threading.local()
+
+    def _open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS
+        )
+        for name, value in self.pragmas:
+            connection.execute("PRAGMA {}={}".format(name, value))
+        return connection
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise sqlite3.ProgrammingError(
+                        "Connection pool for '{}' is closed".format(self.path)
+                    )
+                if self.idle:
+                    return self.idle.pop()
+                if self.opened < self.max_connections:
+                    self.opened += 1
+                    break
+                if not self.condition.wait(POOL_TIMEOUT):
+                    raise sqlite3.OperationalError(
+                        "Timed out waiting for a connection to '{}'".format(
+                            self.path
+                        )
+                    )
+
+        try:
+            return self._open()
+        except Exception:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
+
+    def _release(self, connection: sqlite3.Connection):
+        with self.condition:
+            if self.closed:
+                self.opened -= 1
+                connection.close()
+            else:
+                self.idle.append(connection)
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Gives the current thread a connection for the length of the block,
+        committing when the outermost block ends.
+        """
+        local = self.local
+        connection = getattr(local, "connection", None)
+        if connection is not None:
+            local.depth += 1
+            try:
+                yield connection
+            finally:
+                local.depth -= 1
+            return
+
+        connection = self._acquire()
+        local.connection = connection
+        local.depth = 1
+        try:
+            yield connection
+            if connection.in_transaction:
+                connection.commit()
+        except BaseException:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        finally:
+            local.connection = None
+            self._release(connection)
+
+    def set_pragmas(self, pragmas: tuple):
+        """Changes the pragmas connections are opened with. Idle connections
+        are closed so they're opened again with the new ones.
+        """
+        with self.condition:
+            self.pragmas = pragmas
+            for connection in self.idle:
+                connection.close()
+                self.opened -= 1
+            self.idle.clear()
+            self.condition.notify_all()
+
+    def execute(self, sql: str, parameters=()) -> list:
+        """Runs a single statement and returns all of its rows."""
+        with self.connection() as connection:
+            return connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        """Closes idle connections now, and the rest as they are returned."""
+        with self.condition:
+            self.closed = True
+            for connection in self.idle:
+                connection.close()
+                self.opened -= 1
+            self.idle.clear()
+            self.condition.notify_all()
+
+
+# File locks--------------------------------------------------------------------
+@contextlib.contextmanager
+def locked_file(path: str):
+    """Holds an exclusive lock for a file, shared with other processes, for the
+    length of the block. Read the file again inside the block before changing
+    it, another process may have changed it since.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def replace_file(path: str, text: str):
+    """Writes a file through a temporary file, so it's never left half
+    written.
+    """
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as temporary_file:
+        temporary_file.write(text)
+    os.replace(temporary_path, path)
+
+
+# Outer interface---------------------------------------------------------------
+pools = {}
+pools_lock = threading.Lock()
+
+
+def open_pool(path: str, **kwargs) -> ConnectionPool:
+    """Returns the pool for a database file, creating it the first time. The
+    keyword arguments are passed to ConnectionPool when it's created.
+    """
+    path = os.path.abspath(path)
+    with pools_lock:
+        pool = pools.get(path)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(path, **kwargs)
+            pools[path] = pool
+        return pool
+
+
+def close_all():
+    with pools_lock:
+        closing = list(pools.values())
+        pools.clear()
+    for pool in closing:
+        pool.close()